@@ -0,0 +1,203 @@
+"""
+Band math over the band files of a scene, e.g. NDVI "(B08-B04)/(B08+B04)".
+
+The expression is parsed once to find the bands it needs. It is evaluated
+block by block on a target grid (the finest band by default), coarser bands
+such as the 20m B11/B12 are resampled to it in read_block, and blocks run on
+the raster thread pool, so a full tile only ever has a few blocks of
+float32 inputs in memory. numexpr evaluates each block in one fused pass
+when it is installed, otherwise the expression runs as numpy operations.
+"""
+
+import ast
+import os
+
+import numpy as np
+from osgeo import gdal
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+from satd.bands import NATIVE_RESOLUTION
+from satd.raster import Window, blocks, open_photo, parallel_map, read_block
+
+INDICES = {
+    "NDVI": "(B08 - B04) / (B08 + B04)",
+    "NDWI": "(B03 - B08) / (B03 + B08)",
+    "NDMI": "(B08 - B11) / (B08 + B11)",
+    "NBR": "(B08 - B12) / (B08 + B12)",
+}
+
+# Functions known to both numexpr and numpy
+FUNCTIONS = {
+    "sqrt": np.sqrt,
+    "abs": np.abs,
+    "log": np.log,
+    "exp": np.exp,
+    "where": np.where,
+}
+
+ALLOWED_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Compare,
+    ast.Call,
+    ast.Constant,
+    ast.Name,
+    ast.Load,
+    ast.operator,
+    ast.unaryop,
+    ast.cmpop,
+)
+
+
+class Expression:
+    def __init__(self, expr: str):
+        self.source = INDICES.get(expr.upper(), expr)
+        tree = ast.parse(self.source, mode="eval")
+        bands = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise ValueError(
+                    f"{type(node).__name__} not allowed in {self.source!r}"
+                )
+            if isinstance(node, ast.Call) and (
+                not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS
+            ):
+                raise ValueError(f"Unknown function in {self.source!r}")
+            if isinstance(node, ast.Name) and node.id not in FUNCTIONS:
+                if node.id not in NATIVE_RESOLUTION:
+                    raise ValueError(f"Unknown band {node.id!r} in {self.source!r}")
+                bands.add(node.id)
+        self.bands = sorted(bands)
+        self.code = compile(tree, "<band math>", "eval")
+
+    def evaluate(self, data: dict[str, np.ndarray]) -> np.ndarray:
+        if numexpr is not None:
+            return numexpr.evaluate(self.source, local_dict=data)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return eval(self.code, {"__builtins__": {}, **FUNCTIONS}, data)
+
+    def __repr__(self):
+        return f"Expression({self.source!r})"
+
+
+class BandMath:
+    """
+    Evaluates an expression over {band: path} on the grid of the finest
+    band, or of `resolution` meters (same origin) if given.
+    """
+
+    def __init__(
+        self, expr: str | Expression, paths: dict[str, str], resolution=None
+    ):
+        self.expr = expr if isinstance(expr, Expression) else Expression(expr)
+        missing = set(self.expr.bands) - set(paths)
+        if missing:
+            raise FileNotFoundError(f"No files for bands {sorted(missing)}")
+        self.paths = {band: paths[band] for band in self.expr.bands}
+        photos = [open_photo(path) for path in self.paths.values()]
+        ref = min(photos, key=lambda photo: abs(photo.geo_transform[1]))
+        ref_size = abs(ref.geo_transform[1])
+        self.pixel_size = float(resolution or ref_size)
+        scale = ref_size / self.pixel_size
+        self.xs = int(ref.full_xs * scale)
+        self.ys = int(ref.full_ys * scale)
+        g0, g1, g2, g3, g4, g5 = ref.geo_transform
+        self.geo_transform = (
+            g0,
+            g1 / scale,
+            g2 / scale,
+            g3,
+            g4 / scale,
+            g5 / scale,
+        )
+        self.crs = ref.crs
+
+    def evaluate_block(self, block: tuple[int, int, int, int]) -> np.ndarray:
+        x0, y0, w, h = block
+        data = {}
+        for band, path in self.paths.items():
+            raw = read_block(path, x0, y0, w, h, self.pixel_size)
+            data[band] = raw.astype(np.float32)
+        return self.expr.evaluate(data).astype(np.float32, copy=False)
+
+    def iter_blocks(
+        self, window: tuple[int, int, int, int] = None, block_size: int = 1024
+    ):
+        """
+        Yield ((x0, y0, w, h), float32 block) over the window (x1, y1, x2, y2),
+        a pool's worth of blocks at a time.
+        """
+        x1, y1, x2, y2 = window or (0, 0, self.xs, self.ys)
+        jobs = list(blocks(x1, y1, x2, y2, block_size))
+        batch_size = os.cpu_count() * 2
+        for i in range(0, len(jobs), batch_size):
+            batch = jobs[i : i + batch_size]
+            yield from zip(batch, parallel_map(self.evaluate_block, batch))
+
+    def read(
+        self, window: tuple[int, int, int, int] = None, block_size: int = 1024
+    ) -> Window:
+        x1, y1, x2, y2 = window or (0, 0, self.xs, self.ys)
+        out = np.empty((y2 - y1, x2 - x1), np.float32)
+        for (x0, y0, w, h), data in self.iter_blocks(window, block_size):
+            out[y0 - y1 : y0 - y1 + h, x0 - x1 : x0 - x1 + w] = data
+        g0, g1, g2, g3, g4, g5 = self.geo_transform
+        geo_transform = (
+            g0 + x1 * g1 + y1 * g2,
+            g1,
+            g2,
+            g3 + x1 * g4 + y1 * g5,
+            g4,
+            g5,
+        )
+        return Window(out, geo_transform, self.crs)
+
+    def write(self, dst_path: str, block_size: int = 1024) -> str:
+        """Stream the whole grid to a float32 GeoTIFF, block by block."""
+        ds = gdal.GetDriverByName("GTiff").Create(
+            dst_path,
+            self.xs,
+            self.ys,
+            1,
+            gdal.GDT_Float32,
+            options=["TILED=YES", "COMPRESS=ZSTD", "PREDICTOR=3", "BIGTIFF=YES"],
+        )
+        ds.SetGeoTransform(self.geo_transform)
+        ds.SetProjection(self.crs)
+        band = ds.GetRasterBand(1)
+        band.SetNoDataValue(float("nan"))
+        for (x0, y0, _, _), data in self.iter_blocks(block_size=block_size):
+            band.WriteArray(data, x0, y0)
+        ds = None
+        return dst_path
+
+
+def _bench_bandmath(size: int = 10980, block_size: int = 1024):
+    import tempfile
+    import time
+
+    from satd.raster import make_synthetic
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "band.tif")
+        make_synthetic(path, size)
+        paths = {"B04": path, "B08": path}
+        t0 = time.perf_counter()
+        window = BandMath("NDVI", paths).read(block_size=block_size)
+        dt = time.perf_counter() - t0
+        engine = "numexpr" if numexpr is not None else "numpy"
+        print(
+            f"NDVI {window.data.shape} ({engine}): {dt:.2f} s, "
+            + f"{size * size / 1e6 / dt:.0f} Mpix/s"
+        )
+
+
+if __name__ == "__main__":
+    import sys
+
+    _bench_bandmath(*map(int, sys.argv[1:]))
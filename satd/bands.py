@@ -0,0 +1,143 @@
+"""
+Sentinel-2 band files in a .SAFE product.
+
+L2A: GRANULE/*/IMG_DATA/R10m/T33VWE_20230615T102031_B02_10m.jp2
+L1C: GRANULE/*/IMG_DATA/T33VWE_20230615T102031_B02.jp2
+COG: COG/T33VWE_20230615T102031_B02_10m.tif (see satd.cog)
+
+Bands meaning 02-04 = BGR
+https://custom-scripts.sentinel-hub.com/custom-scripts/sentinel-2/bands/
+"""
+
+import os
+from dataclasses import dataclass
+
+NATIVE_RESOLUTION = {
+    "B01": "60m",
+    "B02": "10m",
+    "B03": "10m",
+    "B04": "10m",
+    "B05": "20m",
+    "B06": "20m",
+    "B07": "20m",
+    "B08": "10m",
+    "B8A": "20m",
+    "B09": "60m",
+    "B10": "60m",
+    "B11": "20m",
+    "B12": "20m",
+    # L2A only
+    "SCL": "20m",
+    "AOT": "10m",
+    "WVP": "10m",
+    "TCI": "10m",
+}
+
+RGB = ["B04", "B03", "B02"]
+
+
+def meters(resolution: str) -> int:
+    return int(resolution.rstrip("m"))
+
+
+def parse_band_file(path: str) -> tuple[str, str] | None:
+    """(band, resolution) of a band file path, None for any other file."""
+    path = path.replace(os.sep, "/")
+    is_jp2 = "/IMG_DATA/" in path and path.endswith(".jp2")
+    is_cog = "/COG/" in "/" + path and path.endswith(".tif")
+    if not is_jp2 and not is_cog:
+        return None
+    parts = os.path.splitext(os.path.basename(path))[0].split("_")
+    if parts[-1].endswith("m") and parts[-1][:-1].isdigit():
+        return parts[-2], parts[-1]
+    if parts[-1] in NATIVE_RESOLUTION:
+        return parts[-1], NATIVE_RESOLUTION[parts[-1]]
+    return None
+
+
+def tile_id(id_str: str) -> str:
+    """MGRS tile of a product, 'S2A_MSIL2A_..._R065_T33VWE_...' -> 'T33VWE'"""
+    for part in id_str.split("_"):
+        if len(part) == 6 and part[0] == "T" and part[1:3].isdigit():
+            return part
+    raise ValueError(f"No tile in {id_str}")
+
+
+def cog_path(band_path: str) -> str:
+    """
+    Where the COG conversion of a band file goes:
+    <product>/GRANULE/.../R10m/X_B02_10m.jp2 -> <product>/COG/X_B02_10m.tif
+    """
+    product_dir = band_path.split(os.sep + "GRANULE" + os.sep)[0]
+    name = os.path.splitext(os.path.basename(band_path))[0]
+    return os.path.join(product_dir, "COG", name + ".tif")
+
+
+def is_metadata_file(path: str) -> bool:
+    path = path.replace(os.sep, "/")
+    return path == "manifest.safe" or (
+        path.endswith(".xml") and "/QI_DATA/" not in path
+    )
+
+
+def best_resolution(available: list[str], resolution: str) -> str:
+    """The requested resolution, else the closest coarser, else closest finer."""
+    available = sorted(available, key=meters)
+    if resolution in available:
+        return resolution
+    coarser = [x for x in available if meters(x) >= meters(resolution)]
+    return coarser[0] if coarser else available[-1]
+
+
+@dataclass
+class DownloadProfile:
+    """Which files of a product to download. bands=None means all bands."""
+
+    bands: list[str] = None
+    resolution: str = "10m"
+    include_scl: bool = False
+    include_metadata: bool = True
+
+    def select(self, paths: list[str]) -> set[str]:
+        available: dict[str, dict[str, str]] = {}
+        selected = set()
+        for path in paths:
+            band_res = parse_band_file(path)
+            if band_res is not None:
+                band, res = band_res
+                available.setdefault(band, {})[res] = path
+            elif self.include_metadata and is_metadata_file(path):
+                selected.add(path)
+
+        bands = set(self.bands) if self.bands is not None else set(available)
+        if self.include_scl:
+            bands.add("SCL")
+        elif self.bands is None:
+            bands.discard("SCL")
+        for band in bands:
+            if band not in available:
+                continue
+            res = best_resolution(list(available[band]), self.resolution)
+            selected.add(available[band][res])
+        return selected
+
+    def union(self, other: "DownloadProfile | None") -> "DownloadProfile | None":
+        """
+        A profile selecting the files of both, None (the whole product) if
+        either is. Of two resolutions the finer one is preferred.
+        """
+        if other is None:
+            return None
+        if self.bands is None or other.bands is None:
+            bands = None
+        else:
+            bands = self.bands + [b for b in other.bands if b not in self.bands]
+        return DownloadProfile(
+            bands=bands,
+            resolution=min(self.resolution, other.resolution, key=meters),
+            include_scl=self.include_scl or other.include_scl,
+            include_metadata=self.include_metadata or other.include_metadata,
+        )
+
+
+RGB_PROFILE = DownloadProfile(bands=RGB, resolution="10m", include_scl=True)
@@ -0,0 +1,36 @@
+"""
+satd command line.
+
+    satd index rebuild <dir> [--db <dir>/index.db] [--workers N] [--prune]
+"""
+
+import argparse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="satd")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index = commands.add_parser("index", help="manage the product index")
+    index_commands = index.add_subparsers(dest="index_command", required=True)
+    rebuild = index_commands.add_parser(
+        "rebuild", help="scan the products on disk into the index"
+    )
+    rebuild.add_argument("dir", help="directory with the .SAFE products")
+    rebuild.add_argument("--db", help="index db, default <dir>/index.db")
+    rebuild.add_argument("--workers", type=int, default=None)
+    rebuild.add_argument(
+        "--prune",
+        action="store_true",
+        help="remove downloaded products no longer on disk",
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "index" and args.index_command == "rebuild":
+        import satd.scan as scan
+
+        scan.main(args)
+
+
+if __name__ == "__main__":
+    main()
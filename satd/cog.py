@@ -0,0 +1,127 @@
+"""
+Optional post-download stage: rewrite band JP2s as cloud optimised GeoTIFFs.
+
+Random window reads from the JP2s (JP2OpenJPEG) have to decode whole
+codeblocks at every resolution level, while a tiled, overview-carrying
+GeoTIFF with a fast codec reads only the tiles it needs. Conversions run in
+a process pool and are recorded in SentinelFile, and
+SentinelImage.get_rgb_photos picks the COG when it exists.
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from osgeo import gdal
+
+from satd.bands import RGB, cog_path, parse_band_file
+from satd.db.table_sentinel_file import SentinelFile
+from satd.db.table_sentinel_image import SentinelImage
+
+gdal.UseExceptions()
+
+
+def convert_band(
+    src_path: str,
+    dst_path: str = None,
+    compress: str = "ZSTD",
+    block_size: int = 512,
+    num_threads: int = 1,
+) -> str:
+    """Convert one band file to a COG, returns the COG path."""
+    dst_path = dst_path or cog_path(src_path)
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    options = [
+        f"COMPRESS={compress}",
+        # Horizontal differencing, UInt16 reflectances compress much better
+        "PREDICTOR=2",
+        f"BLOCKSIZE={block_size}",
+        "OVERVIEWS=AUTO",
+        "OVERVIEW_RESAMPLING=AVERAGE",
+        f"NUM_THREADS={num_threads}",
+        "BIGTIFF=IF_SAFER",
+    ]
+    if compress == "ZSTD":
+        options.append("LEVEL=9")
+    tmp_path = dst_path + ".tmp.tif"
+    gdal.Translate(tmp_path, src_path, format="COG", creationOptions=options)
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+
+def band_paths(image: SentinelImage, dir_path: str, bands: list[str]) -> list[str]:
+    """The finest resolution JP2 of each band, empty unless all are on disk."""
+    return image.band_paths(dir_path, bands, prefer_cog=False) or []
+
+
+def convert_images(
+    images: list[SentinelImage],
+    dir_path: str,
+    bands: list[str] = RGB,
+    workers: int = None,
+    **options,
+) -> list[str]:
+    """
+    Convert `bands` of every image in a process pool, skipping bands that
+    already have a COG. Returns the new COG paths.
+    """
+    jobs = []
+    for image in images:
+        for path in band_paths(image, dir_path, bands):
+            if not os.path.isfile(cog_path(path)):
+                jobs.append((image.id_str, path))
+    if not jobs:
+        return []
+
+    converted = []
+    # Spawned, not forked, so no GDAL handles or sqlite connections are shared
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=spawn) as pool:
+        futures = [pool.submit(convert_band, path, **options) for _, path in jobs]
+        for (id_str, path), future in zip(jobs, futures):
+            dst_path = future.result()
+            band, resolution = parse_band_file(path) or ("", "")
+            rel_path = os.path.relpath(dst_path, os.path.join(dir_path, id_str))
+            SentinelFile.record(
+                SentinelFile(
+                    id_str=id_str,
+                    rel_path=rel_path,
+                    band=band,
+                    resolution=resolution,
+                    size=os.path.getsize(dst_path),
+                    etag="",
+                )
+            )
+            converted.append(dst_path)
+    return converted
+
+
+def _bench_cog(path: str = None, xs: int = 512, ys: int = 512, repeat: int = 5):
+    import tempfile
+    import time
+
+    from satd.raster import Photo, make_synthetic
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if path is None:
+            path = os.path.join(tmp_dir, "synthetic.jp2")
+            make_synthetic(path)
+        t0 = time.perf_counter()
+        tif_path = convert_band(path, os.path.join(tmp_dir, "synthetic.tif"))
+        print(f"convert: {time.perf_counter() - t0:.1f} s")
+        photos = [("jp2", Photo(path)), ("cog", Photo(tif_path))]
+        lon, lat = photos[0][1].get_geod_center()
+        for half in [0.01, 0.05, 0.2, 0.8]:
+            aoi = (lon - half, lat - half / 2, lon + half, lat + half / 2)
+            for name, photo in photos:
+                t0 = time.perf_counter()
+                for _ in range(repeat):
+                    photo.read_aoi(*aoi, xs, ys)
+                dt = (time.perf_counter() - t0) / repeat
+                print(f"half={half:5.2f} deg {name} {dt * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    import sys
+
+    _bench_cog(*sys.argv[1:2])
@@ -0,0 +1,307 @@
+"""
+Cloud masked temporal composites of one tile's time series.
+
+The scenes of a tile share the 10980x10980 (10m) grid, so the composite is
+computed block by block over a pixel window of that grid: each block reads
+the bands of every date plus the L2A scene classification (SCL), masks
+cloud, shadow, cirrus and nodata pixels, and reduces over time. Blocks run
+in a process pool and memory stays at about dates x block_size^2 per worker.
+
+Methods:
+    median      per pixel median of the clear observations
+    percentile  per pixel q:th percentile of the clear observations
+    max_ndvi    all bands of the clear date with the highest NDVI
+"""
+
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from satd.bands import RGB, tile_id
+from satd.db.table_sentinel_image import SentinelImage
+from satd.mosaic import scene_paths
+from satd.raster import Window, blocks, open_photo, read_block
+
+# SCL classes that are not a clear view of the ground: no data, saturated or
+# defective, cloud shadow, cloud medium/high probability, thin cirrus
+MASKED_SCL = np.array([0, 1, 3, 8, 9, 10], np.uint8)
+
+METHODS = ["median", "percentile", "max_ndvi"]
+
+
+def percentile_stack(stack: np.ndarray, valid: np.ndarray, q: float) -> np.ndarray:
+    """
+    Per pixel q:th percentile (linear interpolation) over axis 0 of the
+    valid values of an unsigned integer (T, H, W) stack, 0 where none are
+    valid. Invalid values are sorted last instead of going through float NaNs.
+    """
+    stack = np.where(valid, stack, np.iinfo(stack.dtype).max)
+    stack.sort(axis=0)
+    n = valid.sum(axis=0)
+    pos = np.maximum(n - 1, 0) * (q / 100.0)
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.ceil(pos).astype(np.intp)
+    a = np.take_along_axis(stack, lo[None], axis=0)[0].astype(np.float32)
+    b = np.take_along_axis(stack, hi[None], axis=0)[0].astype(np.float32)
+    out = np.rint(a + (b - a) * (pos - lo)).astype(stack.dtype)
+    out[n == 0] = 0
+    return out
+
+
+def max_ndvi_stack(stack: np.ndarray, valid: np.ndarray, red: int, nir: int):
+    """(T, C, H, W) stack -> (C, H, W) bands of the valid date with max NDVI."""
+    r = stack[:, red].astype(np.float32)
+    n = stack[:, nir].astype(np.float32)
+    ndvi = (n - r) / np.maximum(n + r, 1.0)
+    ndvi[~valid] = -np.inf
+    best = ndvi.argmax(axis=0)
+    out = np.take_along_axis(stack, best[None, None], axis=0)[0]
+    out[:, ~valid.any(axis=0)] = 0
+    return out
+
+
+def reference_photo(paths: list[str]):
+    """The finest of the band files, composites are on its pixel grid."""
+    return min(map(open_photo, paths), key=lambda photo: abs(photo.geo_transform[1]))
+
+
+def read_bands(bands: list[str], method: str) -> list[str]:
+    """bands plus the red and NIR bands max_ndvi needs."""
+    if method != "max_ndvi":
+        return list(bands)
+    return list(bands) + [band for band in ["B04", "B08"] if band not in bands]
+
+
+def composite_block(
+    scenes: list[list[str]],
+    scl_paths: list[str | None],
+    block: tuple[int, int, int, int],
+    pixel_size: float,
+    method: str = "median",
+    q: float = 50.0,
+    red_nir: tuple[int, int] = None,
+) -> np.ndarray:
+    """(h, w, C) composite of one block, runs in the worker processes."""
+    x0, y0, w, h = block
+    num_bands = len(scenes[0])
+    valid = np.empty((len(scenes), h, w), bool)
+    for t, (paths, scl_path) in enumerate(zip(scenes, scl_paths)):
+        if scl_path is None:
+            # L1C, only nodata is masked
+            valid[t] = read_block(paths[0], x0, y0, w, h, pixel_size) > 0
+        else:
+            scl = read_block(scl_path, x0, y0, w, h, pixel_size)
+            valid[t] = ~np.isin(scl, MASKED_SCL)
+
+    if method == "max_ndvi":
+        stack = np.empty((len(scenes), num_bands, h, w), np.uint16)
+        for t, paths in enumerate(scenes):
+            for c, path in enumerate(paths):
+                stack[t, c] = read_block(path, x0, y0, w, h, pixel_size)
+        return np.moveaxis(max_ndvi_stack(stack, valid, *red_nir), 0, -1)
+
+    if method == "median":
+        q = 50.0
+    out = np.empty((h, w, num_bands), np.uint16)
+    stack = np.empty((len(scenes), h, w), np.uint16)
+    for c in range(num_bands):
+        for t, paths in enumerate(scenes):
+            stack[t] = read_block(paths[c], x0, y0, w, h, pixel_size)
+        out[..., c] = percentile_stack(stack, valid, q)
+    return out
+
+
+def composite_paths(
+    scenes: list[list[str]],
+    scl_paths: list[str | None],
+    window: tuple[int, int, int, int] = None,
+    method: str = "median",
+    q: float = 50.0,
+    red_nir: tuple[int, int] = None,
+    block_size: int = 512,
+    workers: int = None,
+) -> Window:
+    """
+    Composite of band files on the same grid, scenes[t][c] is band c of
+    date t. window is (x1, y1, x2, y2) in pixels of the finest band, the
+    whole tile by default.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown method {method!r}, expected one of {METHODS}")
+    if method == "max_ndvi" and red_nir is None:
+        raise ValueError("max_ndvi needs the indices of the red and NIR bands")
+    photo = reference_photo(scenes[0])
+    pixel_size = abs(photo.geo_transform[1])
+    x1, y1, x2, y2 = window or (0, 0, photo.full_xs, photo.full_ys)
+    out = np.zeros((y2 - y1, x2 - x1, len(scenes[0])), np.uint16)
+
+    jobs = list(blocks(x1, y1, x2, y2, block_size))
+    # Spawned, forked children would share the parent's cached GDAL handles
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=spawn) as pool:
+        futures = [
+            pool.submit(
+                composite_block,
+                scenes,
+                scl_paths,
+                block,
+                pixel_size,
+                method,
+                q,
+                red_nir,
+            )
+            for block in jobs
+        ]
+        for (x0, y0, w, h), future in zip(jobs, futures):
+            out[y0 - y1 : y0 - y1 + h, x0 - x1 : x0 - x1 + w] = future.result()
+
+    g0, g1, g2, g3, g4, g5 = photo.geo_transform
+    e, n = photo.pixel_to_crs(x1, y1)
+    return Window(out, (e, g1, g2, n, g4, g5), photo.crs)
+
+
+def composite(
+    images: list[SentinelImage],
+    dir_path: str,
+    bands: list[str] = RGB,
+    method: str = "median",
+    q: float = 50.0,
+    window: tuple[int, int, int, int] = None,
+    **kwargs,
+) -> Window:
+    """
+    Composite of downloaded scenes of one tile, images without all of the
+    bands on disk are skipped. See composite_paths for window and kwargs.
+    """
+    tiles = {tile_id(image.id_str) for image in images}
+    if len(tiles) > 1:
+        raise ValueError(f"Images from several tiles {tiles}, see composite_bbox")
+    names = read_bands(bands, method)
+    scenes, scl_paths = [], []
+    for image in images:
+        paths = scene_paths(image, dir_path, names)
+        if paths is None:
+            continue
+        scl = scene_paths(image, dir_path, ["SCL"])
+        scenes.append(paths)
+        scl_paths.append(scl[0] if scl else None)
+    if not scenes:
+        raise FileNotFoundError(f"None of the images have {names} downloaded")
+    red_nir = None
+    if method == "max_ndvi":
+        red_nir = (names.index("B04"), names.index("B08"))
+    result = composite_paths(
+        scenes, scl_paths, window, method, q, red_nir, **kwargs
+    )
+    result.data = result.data[..., : len(bands)]
+    return result
+
+
+def composite_bbox(
+    bbox,
+    dir_path: str,
+    time_range: str | tuple[str, str],
+    bands: list[str] = RGB,
+    method: str = "median",
+    max_cloud: float = None,
+    **kwargs,
+) -> dict[str, Window]:
+    """Composite per tile intersecting the lon/lat bbox, {tile: Window}."""
+    by_tile: dict[str, list[SentinelImage]] = {}
+    for image in SentinelImage.select_bbox(bbox, time_range, max_cloud):
+        by_tile.setdefault(tile_id(image.id_str), []).append(image)
+    names = read_bands(bands, method)
+    results = {}
+    for tile, images in by_tile.items():
+        paths = next(
+            (p for p in (scene_paths(i, dir_path, names) for i in images) if p),
+            None,
+        )
+        if paths is None:
+            continue
+        # In pixels of the grid composite_paths reads on
+        x1, y1, x2, y2 = reference_photo(paths).pixel_window(*bbox)
+        window = (math.floor(x1), math.floor(y1), math.ceil(x2), math.ceil(y2))
+        if window[2] <= window[0] or window[3] <= window[1]:
+            continue
+        results[tile] = composite(
+            images, dir_path, bands, method, window=window, **kwargs
+        )
+    return results
+
+
+def _check_composite(dates: int = 9, size: int = 64):
+    rng = np.random.default_rng(0)
+    stack = rng.integers(1, 10000, (dates, size, size), dtype=np.uint16)
+    valid = rng.random((dates, size, size)) > 0.4
+    valid[:, 0, 0] = False
+    expected = np.nanpercentile(np.where(valid, stack, np.nan), [50, 25], axis=0)
+    for q, exp in zip([50, 25], expected):
+        got = percentile_stack(stack, valid, q)
+        assert got[0, 0] == 0
+        exp = np.rint(np.nan_to_num(exp)).astype(np.uint16)
+        assert np.abs(got.astype(int) - exp).max() <= 1, q
+
+    bands = rng.integers(1, 10000, (dates, 2, size, size), dtype=np.uint16)
+    got = max_ndvi_stack(bands, valid, 0, 1)
+    r, n = bands[:, 0].astype(np.float64), bands[:, 1].astype(np.float64)
+    ndvi = np.where(valid, (n - r) / (n + r), -np.inf)
+    best = ndvi.argmax(axis=0)
+    yy, xx = np.mgrid[:size, :size]
+    expected = bands[best, :, yy, xx].transpose(2, 0, 1)
+    clear = valid.any(axis=0)
+    assert (got[:, clear] == expected[:, clear]).all()
+    assert (got[:, ~clear] == 0).all()
+    print("composite ok")
+
+
+def _bench_composite(size: int = 4096, dates: int = 8, workers: int = None):
+    import tempfile
+    import time
+
+    from osgeo import gdal
+
+    from satd.raster import make_synthetic
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        band_path = os.path.join(tmp_dir, "band.tif")
+        make_synthetic(band_path, size)
+        ds = gdal.Open(band_path)
+        rng = np.random.default_rng(0)
+        scl_paths = []
+        for t in range(dates):
+            scl = rng.choice([4, 5, 8, 9], (size // 2, size // 2)).astype(np.uint8)
+            mem = gdal.GetDriverByName("MEM").Create(
+                "", size // 2, size // 2, 1, gdal.GDT_Byte
+            )
+            g = ds.GetGeoTransform()
+            mem.SetGeoTransform((g[0], g[1] * 2, g[2], g[3], g[4], g[5] * 2))
+            mem.SetProjection(ds.GetProjection())
+            mem.GetRasterBand(1).WriteArray(scl)
+            scl_paths.append(os.path.join(tmp_dir, f"scl_{t}.tif"))
+            gdal.GetDriverByName("GTiff").CreateCopy(scl_paths[-1], mem)
+        # Same band file for every date, the reads are what is measured
+        scenes = [[band_path] * 3 for _ in range(dates)]
+        for method in ["median", "max_ndvi"]:
+            t0 = time.perf_counter()
+            result = composite_paths(
+                scenes, scl_paths, method=method, red_nir=(0, 1), workers=workers
+            )
+            dt = time.perf_counter() - t0
+            # Input pixels, every date of every band
+            mpix = size * size * dates * 3 / 1e6
+            print(
+                f"{method:10s} {result.data.shape} {dates} dates: "
+                + f"{dt:.1f} s, {mpix / dt:.0f} Mpix/s"
+            )
+
+
+if __name__ == "__main__":
+    import sys
+
+    _check_composite()
+    if sys.argv[1:2] == ["bench"]:
+        _bench_composite(*map(int, sys.argv[2:]))
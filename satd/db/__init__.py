@@ -1,2 +1,5 @@
-from satd.db.table import init_db
+from satd.db.table import init_db, get_db, transaction
 from satd.db.table_sentinel_image import *
+from satd.db.table_sentinel_file import *
+from satd.db.table_ingest_job import *
+from satd.db.table_sync_state import *
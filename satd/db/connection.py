@@ -0,0 +1,121 @@
+from contextlib import contextmanager
+import os
+import sqlite3
+from sqlite3 import Connection
+import tempfile
+import threading
+import weakref
+
+default_pragmas = {
+    "journal_mode": "WAL",
+    # Safe with WAL, only the last transactions can be lost on power failure
+    "synchronous": "NORMAL",
+    # Negative means KiB, so 64 MiB page cache per connection
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+
+
+class _ThreadConnection:
+    """Holds a thread's connection, which is closed when the thread is gone."""
+
+    def __init__(self, db: Connection):
+        self.db = db
+        self.depth = 0
+        weakref.finalize(self, db.close)
+
+
+class Database:
+    """
+    One sqlite connection per thread to the same database file.
+
+    With WAL journaling readers don't block the writer and vice versa, so a
+    background ingest can write while the GUI or other threads read.
+    """
+
+    def __init__(self, path: str, timeout: float = 30.0, **pragmas):
+        self.path = path
+        self.tmp_dir = None
+        if path == ":memory:":
+            # A temporary WAL database file instead of a shared cache memory
+            # database, whose table locks (SQLITE_LOCKED) ignore the timeout
+            self.path = None
+        self.timeout = timeout
+        self.pragmas = {**default_pragmas, **pragmas}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections: weakref.WeakSet[_ThreadConnection] = weakref.WeakSet()
+
+    def connect(self) -> Connection:
+        with self.lock:
+            if self.path is None:
+                self.tmp_dir = tempfile.TemporaryDirectory(prefix="satd_db_")
+                self.path = os.path.join(self.tmp_dir.name, "memory.db")
+        db = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        for key, value in self.pragmas.items():
+            db.execute(f"PRAGMA {key}={value};")
+        return db
+
+    def _thread_connection(self) -> _ThreadConnection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = _ThreadConnection(self.connect())
+            # Dropped with the thread-local when the thread exits
+            self.local.conn = conn
+            with self.lock:
+                self.connections.add(conn)
+        return conn
+
+    def get(self) -> Connection:
+        return self._thread_connection().db
+
+    def in_transaction(self) -> bool:
+        conn = getattr(self.local, "conn", None)
+        return conn is not None and conn.depth > 0
+
+    @contextmanager
+    def transaction(self, immediate: bool = True):
+        """
+        Commit everything in the block at once, or roll back on error.
+        Nested blocks join the outermost transaction.
+        """
+        conn = self._thread_connection()
+        db = conn.db
+        if conn.depth > 0:
+            conn.depth += 1
+            try:
+                yield db
+            finally:
+                conn.depth -= 1
+            return
+        if db.in_transaction:
+            db.commit()
+        db.execute("BEGIN IMMEDIATE;" if immediate else "BEGIN;")
+        conn.depth = 1
+        try:
+            yield db
+        except:
+            db.rollback()
+            raise
+        else:
+            db.commit()
+        finally:
+            conn.depth = 0
+
+    def commit(self):
+        # Inside transaction() the outermost block commits
+        if not self.in_transaction():
+            self.get().commit()
+
+    def close(self):
+        with self.lock:
+            for conn in list(self.connections):
+                conn.db.close()
+            self.connections = weakref.WeakSet()
+        self.local = threading.local()
+        if self.tmp_dir is not None:
+            self.tmp_dir.cleanup()
+            self.tmp_dir = None
+            self.path = None
@@ -1,10 +1,13 @@
 from satd.db.table import (
     Table,
     get_db,
+    commit,
+    transaction,
     dataclass,
     fields,
     field,
     PRIMARY_KEY,
+    INDEX,
     type_mapping,
 )
 from collections import namedtuple
@@ -29,6 +32,10 @@ class Bbox(namedtuple("Bbox", ["min_x", "min_y", "max_x", "max_y"])):
         min_x, max_x, min_y, max_y = map(float, text.split(","))
         return Bbox(min_x, min_y, max_x, max_y)
 
+    def rtree_values(self):
+        # Column order of the rtree index, not of the namedtuple
+        return (self.min_x, self.max_x, self.min_y, self.max_y)
+
 
 type_mapping[Bbox] = "TEXT"
 
@@ -49,16 +56,76 @@ class GeoTable(Table):
             + "USING rtree(id, min_x, max_x, min_y, max_y);"
         )
         get_db().execute(statement)
-        get_db().commit()
+        commit()
+        if cls._index_outdated():
+            cls.rebuild_index()
+
+    @classmethod
+    def _index_outdated(cls, sample: int = 100) -> bool:
+        """
+        Rows missing from the index, or boxes written in the namedtuple order
+        (min_x, min_y, max_x, max_y) by older versions.
+        """
+        table_name = cls.__name__
+        index_name = cls.index_name()
+        db = get_db()
+        (rows,) = db.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()
+        (indexed,) = db.execute(f"SELECT COUNT(*) FROM {index_name};").fetchone()
+        if rows != indexed:
+            return True
+        statement = (
+            f"SELECT {table_name}.bbox, min_x, max_x, min_y, max_y "
+            + f"FROM {table_name}, {index_name} "
+            + f"WHERE {table_name}.id={index_name}.id LIMIT ?;"
+        )
+        for text, *box in db.execute(statement, (sample,)):
+            expected = Bbox.__from_db__(text).rtree_values()
+            # The rtree stores 32 bit floats, rounded outwards
+            if any(abs(a - b) > 1e-3 for a, b in zip(box, expected)):
+                return True
+        return False
+
+    @classmethod
+    def rebuild_index(cls):
+        """Recreate the rtree index from the bbox column."""
+        insert = f"INSERT INTO {cls.index_name()} VALUES (?, ?, ?, ?, ?)"
+        with transaction():
+            rows = get_db().execute(f"SELECT id, bbox FROM {cls.__name__};")
+            values = [
+                (row_id,) + Bbox.__from_db__(text).rtree_values()
+                for row_id, text in rows.fetchall()
+            ]
+            get_db().execute(f"DELETE FROM {cls.index_name()};")
+            get_db().executemany(insert, values)
 
     @classmethod
     def insert(cls, obj):
-        row_id = super().insert(obj)
         statement = f"INSERT INTO {cls.index_name()} VALUES (?, ?, ?, ?, ?)"
-        values = (row_id,) + obj.bbox
-        get_db().execute(statement, values)
-        # print(statement, values)
-        get_db().commit()
+        with transaction():
+            row_id = super().insert(obj)
+            values = (row_id,) + obj.bbox.rtree_values()
+            get_db().execute(statement, values)
+        return row_id
+
+    @classmethod
+    def _insert_chunk(cls, objs):
+        ids = super()._insert_chunk(objs)
+        statement = f"INSERT INTO {cls.index_name()} VALUES (?, ?, ?, ?, ?)"
+        values = [
+            (row_id,) + obj.bbox.rtree_values() for row_id, obj in zip(ids, objs)
+        ]
+        get_db().executemany(statement, values)
+        return ids
+
+    @classmethod
+    def delete(cls, where: str, values=()) -> int:
+        statement = (
+            f"DELETE FROM {cls.index_name()} WHERE id IN "
+            + f"(SELECT id FROM {cls.__name__} WHERE {where});"
+        )
+        with transaction():
+            get_db().execute(statement, values)
+            return super().delete(where, values)
 
     @classmethod
     def select(cls):
@@ -66,18 +133,78 @@ class GeoTable(Table):
 
     @classmethod
     def select_point(cls, point):
+        statement, values = cls._point_query(point)
+        return super()._extract_rows(get_db().execute(statement, values).fetchall())
+
+    @classmethod
+    def _point_query(cls, point, columns=None):
         x, y = point
         table_name = cls.__name__
         index_name = cls.index_name()
-        names = [field.name for field in fields(cls)]
-        names = [f"{table_name}.{x}" for x in names]
-        names_str = ",".join(names)
-        statement = f"""
-            SELECT {names_str} FROM {table_name}, {index_name}
-            WHERE {table_name}.id={index_name}.id 
-            AND min_x <= ? AND max_x >= ?
-            AND min_y <= ? AND max_y >= ?;
-        """
-        values = (x, x, y, y)
-        print(statement, values)
-        return super()._extract_rows(get_db().execute(statement, values).fetchall())
+        where = (
+            f"{table_name}.id={index_name}.id "
+            + "AND min_x <= ? AND max_x >= ? AND min_y <= ? AND max_y >= ?"
+        )
+        statement = cls._select_statement(
+            columns, f"{table_name}, {index_name}", where
+        )
+        return statement, (x, x, y, y)
+
+    @classmethod
+    def iter_select_point(
+        cls,
+        point,
+        columns: list[str] = None,
+        batch_size: int = 1000,
+        as_tuple: bool = False,
+    ):
+        statement, values = cls._point_query(point, columns)
+        return cls._iter_query(statement, values, columns, batch_size, as_tuple)
+
+    @classmethod
+    def iter_select_point_arrays(
+        cls, point, columns: list[str] = None, batch_size: int = 10000
+    ):
+        statement, values = cls._point_query(point, columns)
+        return cls._iter_arrays(statement, values, columns, batch_size)
+
+    @classmethod
+    def _bbox_query(
+        cls,
+        bbox,
+        where: str = None,
+        values=(),
+        columns: list[str] = None,
+        order_by: str = None,
+        limit: int = None,
+    ):
+        min_x, min_y, max_x, max_y = bbox
+        table_name = cls.__name__
+        index_name = cls.index_name()
+        # Intersects: the rtree rows whose box overlaps bbox
+        full_where = (
+            f"{table_name}.id={index_name}.id "
+            + "AND min_x <= ? AND max_x >= ? AND min_y <= ? AND max_y >= ?"
+        )
+        if where:
+            full_where += f" AND ({where})"
+        statement = cls._select_statement(
+            columns, f"{table_name}, {index_name}", full_where
+        )
+        statement += cls._order_limit(order_by, limit)
+        return statement, (max_x, min_x, max_y, min_y, *values)
+
+    @classmethod
+    def select_bbox(
+        cls,
+        bbox,
+        where: str = None,
+        values=(),
+        order_by: str = None,
+        limit: int = None,
+    ):
+        """All rows whose bbox intersects `bbox` (min_x, min_y, max_x, max_y)."""
+        statement, values = cls._bbox_query(
+            bbox, where, values, order_by=order_by, limit=limit
+        )
+        return cls._extract_rows(get_db().execute(statement, values).fetchall())
@@ -5,16 +5,23 @@ import sqlite3
 from sqlite3 import Connection
 import os
 
+from satd.db.connection import Database
+
 PRIMARY_KEY = "PRIMARY KEY"
+INDEX = "INDEX"
+
+# Max host parameters of older SQLite builds
+MAX_VARIABLES = 999
 
 type_mapping = {
     int: "INTEGER",
     str: "TEXT",
     float: "REAL",
+    bytes: "BLOB",
 }
 
 db_primitives = set([
-    int, str, float,
+    int, str, float, bytes,
 ])
 
 def type_to_sqlite_type(t):
@@ -28,8 +35,113 @@ def str_join(*args, sep=" "):
 
 
 
+def _compile(name, src, env):
+    exec(src, env)
+    return env[name]
+
+
+def compile_encoder(cls, names):
+    """Generate `encode(obj) -> tuple` for the given fields of cls."""
+    env = {}
+    values = []
+    for field in fields(cls):
+        if field.name not in names:
+            continue
+        if hasattr(field.type, "__to_db__"):
+            env[f"to_db_{field.name}"] = field.type.__to_db__
+            values.append(f"to_db_{field.name}(obj.{field.name})")
+        else:
+            values.append(f"obj.{field.name}")
+    src = f"def encode(obj):\n    return ({', '.join(values)},)\n"
+    return _compile("encode", src, env)
+
+
+def compile_decoder(cls, names, as_tuple: bool = False):
+    """
+    Generate `decode(row)` for rows selected in `names` order, returning a cls
+    instance, or a plain tuple of the decoded values if as_tuple.
+    """
+    env = {"cls": cls}
+    types = {field.name: field.type for field in fields(cls)}
+    values = []
+    for i, name in enumerate(names):
+        if hasattr(types[name], "__from_db__"):
+            env[f"from_db_{name}"] = types[name].__from_db__
+            values.append(f"from_db_{name}(row[{i}])")
+        else:
+            values.append(f"row[{i}]")
+    if as_tuple:
+        src = f"def decode(row):\n    return ({', '.join(values)},)\n"
+    else:
+        args = [f"{name}={value}" for name, value in zip(names, values)]
+        src = f"def decode(row):\n    return cls({', '.join(args)})\n"
+    return _compile("decode", src, env)
+
+
+numpy_types = {
+    int: "i8",
+    float: "f8",
+}
+
+
+class Schema:
+    """SQL statements and row codecs of a Table class, built once per class."""
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.table_name = cls.__name__
+        self.names = [field.name for field in fields(cls)]
+        self.insert_names = [
+            field.name for field in fields(cls) if PRIMARY_KEY not in field.metadata
+        ]
+        qs = ", ".join(["?"] * len(self.insert_names))
+        self.insert_statement = (
+            f"INSERT INTO {self.table_name} ({', '.join(self.insert_names)}) "
+            + f"VALUES ({qs});"
+        )
+        self.primary_key = next(
+            (field.name for field in fields(cls) if PRIMARY_KEY in field.metadata),
+            None,
+        )
+        self.insert_with_id_statement = None
+        if self.primary_key is not None:
+            # Rows are (id,) + encode(obj), the key first wherever it's declared
+            id_names = [self.primary_key] + self.insert_names
+            qs = ", ".join(["?"] * len(id_names))
+            self.insert_with_id_statement = (
+                f"INSERT INTO {self.table_name} ({', '.join(id_names)}) "
+                + f"VALUES ({qs});"
+            )
+        # No trailing ';' so callers can append WHERE/ORDER BY
+        self.columns = ", ".join(f"{self.table_name}.{x}" for x in self.names)
+        self.select_statement = f"SELECT {self.columns} FROM {self.table_name}"
+        self.encode = compile_encoder(cls, self.insert_names)
+        self.decode = compile_decoder(cls, self.names)
+        self.types = {field.name: field.type for field in fields(cls)}
+        self._tuple_decoders = {}
+
+    def check_columns(self, columns):
+        for name in columns:
+            if name not in self.types:
+                raise Exception(f"{self.table_name} has no column {name}")
+
+    def tuple_decoder(self, columns):
+        columns = tuple(columns)
+        if columns not in self._tuple_decoders:
+            self._tuple_decoders[columns] = compile_decoder(
+                self.cls, columns, as_tuple=True
+            )
+        return self._tuple_decoders[columns]
+
+    def numpy_dtype(self, columns):
+        # Anything that is not a number (str, Bbox, ...) is stored as object
+        return [(name, numpy_types.get(self.types[name], "O")) for name in columns]
+
+
 @dataclass
 class Table:
+    _schema: ClassVar[Schema] = None
+
     @classmethod
     def create_table(cls):
         table_name = cls.__name__
@@ -49,78 +161,271 @@ class Table:
             sep="\n",
         )
         get_db().execute(statement)
-        get_db().commit()
+        # Fields added after the table was created, NULL in the old rows
+        existing = {
+            row[1]
+            for row in get_db().execute(f"PRAGMA table_info({table_name});")
+        }
+        for field in fields(cls):
+            if field.name not in existing:
+                get_db().execute(
+                    f"ALTER TABLE {table_name} ADD COLUMN {field.name} "
+                    + type_to_sqlite_type(field.type)
+                )
+        for field in fields(cls):
+            if INDEX in field.metadata:
+                get_db().execute(
+                    f"CREATE INDEX IF NOT EXISTS {table_name}_{field.name} "
+                    + f"ON {table_name}({field.name});"
+                )
+        commit()
+
+    @classmethod
+    def schema(cls) -> "Schema":
+        # Looked up in cls.__dict__ so subclasses don't reuse the parent's schema
+        schema = cls.__dict__.get("_schema")
+        if schema is None:
+            schema = Schema(cls)
+            cls._schema = schema
+        return schema
 
     @classmethod
     def _get_insert_row(cls, obj):
-        row = []
-        for field in fields(cls):
-            val = getattr(obj, field.name)
-            if PRIMARY_KEY in field.metadata:
-                pass
-            elif hasattr(val, "__to_db__"):
-                row.append(val.__to_db__())
-            elif type(val) in db_primitives:
-                row.append(val)
-            else:
-                raise Exception(f"{type(val)} has no method __to_db__")
-        return row
+        return cls.schema().encode(obj)
 
     @classmethod
     def insert(cls, obj):
-        field_names = [
-            field.name for field in fields(cls) if PRIMARY_KEY not in field.metadata
-        ]
-        row = cls._get_insert_row(obj)
-
-        qs = ", ".join(["?"] * len(field_names))
-        statement = (
-            f"INSERT INTO {cls.__name__} ({', '.join(field_names)}) VALUES ({qs});"
-        )
-        cur = get_db().execute(statement, row)
-        get_db().commit()
+        schema = cls.schema()
+        cur = get_db().execute(schema.insert_statement, schema.encode(obj))
+        commit()
         return cur.lastrowid
 
+    @classmethod
+    def _next_ids(cls, n):
+        # Must be called inside a write transaction so no one else can grab ids
+        statement = f"SELECT MAX({cls.schema().primary_key}) FROM {cls.__name__};"
+        (max_id,) = get_db().execute(statement).fetchone()
+        start = (max_id or 0) + 1
+        return list(range(start, start + n))
+
+    @classmethod
+    def _insert_chunk(cls, objs):
+        schema = cls.schema()
+        encode = schema.encode
+        if schema.primary_key is None:
+            rows = [encode(obj) for obj in objs]
+            get_db().executemany(schema.insert_statement, rows)
+            return []
+        ids = cls._next_ids(len(objs))
+        rows = [(id,) + encode(obj) for id, obj in zip(ids, objs)]
+        get_db().executemany(schema.insert_with_id_statement, rows)
+        return ids
+
+    @classmethod
+    def insert_many(cls, objs, chunk_size: int = None):
+        """
+        Insert all objs with executemany, one transaction per chunk
+        (or one in total if chunk_size is None). Returns the assigned ids,
+        none for tables without a primary key.
+        """
+        objs = list(objs)
+        chunk_size = chunk_size or max(len(objs), 1)
+        ids = []
+        for i in range(0, len(objs), chunk_size):
+            with transaction():
+                ids += cls._insert_chunk(objs[i : i + chunk_size])
+        return ids
 
     @classmethod
     def _extract_row(cls, row):
-        dict_row = {}
-        for i, field in enumerate(fields(cls)):
-            field_cls = field.type
-            val = row[i]
-            if hasattr(field_cls, "__from_db__"):
-                val = field_cls.__from_db__(val)
-            # Maybe log err if not primitive?
-            dict_row[field.name] = val
-        
-        return cls(**dict_row)
+        return cls.schema().decode(row)
 
     @classmethod
     def _extract_rows(cls, rows):
-        return [cls._extract_row(row) for row in rows]
+        decode = cls.schema().decode
+        return [decode(row) for row in rows]
 
     @classmethod
     def select(cls):
-        field_names = [field.name for field in fields(cls)]
-        statement = f"SELECT {' ,'.join(field_names)} FROM {cls.__name__};"
-        return cls._extract_rows(get_db().execute(statement).fetchall())
+        schema = cls.schema()
+        return cls._extract_rows(get_db().execute(schema.select_statement).fetchall())
+
+    @classmethod
+    def _iter_query(
+        cls, statement, values, columns=None, batch_size=1000, as_tuple=False
+    ):
+        schema = cls.schema()
+        if columns is None and not as_tuple:
+            decode = schema.decode
+        else:
+            decode = schema.tuple_decoder(columns or schema.names)
+        cur = get_db().execute(statement, values)
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield decode(row)
+        finally:
+            cur.close()
+
+    @classmethod
+    def _select_statement(cls, columns, from_clause, where):
+        schema = cls.schema()
+        if columns is None:
+            column_str = schema.columns
+        else:
+            schema.check_columns(columns)
+            column_str = ", ".join(f"{schema.table_name}.{x}" for x in columns)
+        statement = f"SELECT {column_str} FROM {from_clause}"
+        if where:
+            statement += f" WHERE {where}"
+        return statement
+
+    @classmethod
+    def iter_select(
+        cls,
+        where: str = None,
+        values=(),
+        columns: list[str] = None,
+        batch_size: int = 1000,
+        as_tuple: bool = False,
+    ):
+        """
+        Stream rows with fetchmany instead of materialising the whole table.
+        Full rows are decoded as cls instances. With `columns`, only those
+        columns are selected and decoded, and rows come back as tuples.
+        """
+        statement = cls._select_statement(columns, cls.__name__, where)
+        return cls._iter_query(statement, values, columns, batch_size, as_tuple)
+
+    @classmethod
+    def _iter_arrays(cls, statement, values, columns, batch_size):
+        import numpy as np
+
+        schema = cls.schema()
+        columns = columns or schema.names
+        dtype = schema.numpy_dtype(columns)
+        decode = schema.tuple_decoder(columns)
+        cur = get_db().execute(statement, values)
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                arr = np.empty(len(rows), dtype=dtype)
+                arr[:] = [decode(row) for row in rows]
+                yield arr
+        finally:
+            cur.close()
+
+    @classmethod
+    def iter_select_arrays(
+        cls,
+        where: str = None,
+        values=(),
+        columns: list[str] = None,
+        batch_size: int = 10000,
+    ):
+        """Like iter_select, but yields one numpy structured array per batch."""
+        statement = cls._select_statement(columns, cls.__name__, where)
+        return cls._iter_arrays(statement, values, columns, batch_size)
 
     @classmethod
     def contains(cls, id, id_key: str ="id"):
-        statement = f"SELECT id FROM {cls.__name__} WHERE {id_key}=?;"
-        res = get_db().execute(statement, [id]).fetchall()
-        return len(res) > 0
+        cls.schema().check_columns([id_key])
+        statement = f"SELECT 1 FROM {cls.__name__} WHERE {id_key}=? LIMIT 1;"
+        return get_db().execute(statement, [id]).fetchone() is not None
+
+    @classmethod
+    def delete(cls, where: str, values=()) -> int:
+        """Delete the rows matching where, returns the number deleted."""
+        statement = f"DELETE FROM {cls.__name__} WHERE {where};"
+        cur = get_db().execute(statement, values)
+        commit()
+        return cur.rowcount
+
+    @classmethod
+    def existing(cls, values, key: str = "id") -> set:
+        """The values present in column key, one IN query per chunk."""
+        cls.schema().check_columns([key])
+        values = list(values)
+        found = set()
+        for i in range(0, len(values), MAX_VARIABLES):
+            chunk = values[i : i + MAX_VARIABLES]
+            statement = (
+                f"SELECT {key} FROM {cls.__name__} "
+                + f"WHERE {key} IN ({', '.join('?' * len(chunk))});"
+            )
+            found.update(row[0] for row in get_db().execute(statement, chunk))
+        return found
+
+    @classmethod
+    def _order_limit(cls, order_by: str = None, limit: int = None):
+        clause = ""
+        if order_by:
+            name, *direction = order_by.split()
+            cls.schema().check_columns([name])
+            if direction and direction[0].upper() not in ("ASC", "DESC"):
+                raise Exception(f"Invalid order direction {direction[0]}")
+            clause += f" ORDER BY {cls.__name__}.{name} {' '.join(direction)}"
+        if limit is not None:
+            clause += f" LIMIT {int(limit)}"
+        return clause
+
+    @classmethod
+    def explain(cls, statement, values=()):
+        """Return the detail column of EXPLAIN QUERY PLAN for statement."""
+        rows = get_db().execute("EXPLAIN QUERY PLAN " + statement, values)
+        return [row[3] for row in rows.fetchall()]
+
+
+database: Database = Database(":memory:")
+
+def init_db(db_path: str, **pragmas):
+    global database
+    old = database
+    database = Database(db_path, **pragmas)
+    old.close()
+
+def get_database() -> Database:
+    return database
+
+def get_db() -> Connection:
+    """The calling thread's connection."""
+    return database.get()
+
+def transaction(immediate: bool = True):
+    return database.transaction(immediate)
+
+def commit():
+    database.commit()
 
+def _check_insert_many():
+    @dataclass(kw_only=True)
+    class Tagged(Table):
+        name: str
+        id: int = field(default=-1, metadata={PRIMARY_KEY: True})
+        value: float
 
-db: Connection = sqlite3.connect(":memory:")
+    @dataclass
+    class Pair(Table):
+        key: str
+        value: float
 
-def init_db(db_path: str):
-    global db
-    db = sqlite3.connect(db_path)
+    init_db(":memory:")
+    Tagged.create_table()
+    Pair.create_table()
+    Tagged.insert(Tagged(name="a", value=1.0))
+    ids = Tagged.insert_many([Tagged(name="b", value=2.0), Tagged(name="c", value=3.0)])
+    assert ids == [2, 3], ids
+    assert [(x.id, x.name) for x in Tagged.select()] == [(1, "a"), (2, "b"), (3, "c")]
+    Pair.insert(Pair("a", 1.0))
+    assert Pair.insert_many([Pair("b", 2.0), Pair("c", 3.0)], chunk_size=1) == []
+    assert Pair.select() == [Pair("a", 1.0), Pair("b", 2.0), Pair("c", 3.0)]
+    print("insert_many ok")
 
-def get_db():
-    return db
 
 if __name__ == "__main__":
-    table = Table(1)
-    Table.create_table()
+    _check_insert_many()
@@ -0,0 +1,228 @@
+import json
+import time
+from dataclasses import asdict
+
+from satd.db.table import (
+    Table,
+    get_db,
+    commit,
+    dataclass,
+    field,
+    transaction,
+    PRIMARY_KEY,
+    INDEX,
+    MAX_VARIABLES,
+)
+from satd.bands import DownloadProfile
+from satd.search import Feature
+
+QUEUED = "queued"
+DOWNLOADING = "downloading"
+DONE = "done"
+FAILED = "failed"
+STATES = [QUEUED, DOWNLOADING, DONE, FAILED]
+
+
+@dataclass(kw_only=True)
+class IngestJob(Table):
+    """
+    A product queued for download by the ingest workers (satd.ingest). The
+    SentinelImage row is only inserted once all of its files are on disk.
+    """
+
+    id: int = field(default=-1, metadata={PRIMARY_KEY: True})
+    id_str: str = field(metadata={INDEX: True})
+    state: str = field(default=QUEUED, metadata={INDEX: True})
+    s3_href: str
+    # STAC feature json, becomes the SentinelImage row
+    feature: str
+    # DownloadProfile fields as json, empty for the whole product
+    profile: str = ""
+    attempts: int = 0
+    next_attempt: float = 0.0
+    error: str = ""
+    worker: str = ""
+    bytes_done: int = 0
+    bytes_total: int = 0
+    updated: float = 0.0
+
+    def download_profile(self) -> DownloadProfile | None:
+        return DownloadProfile(**json.loads(self.profile)) if self.profile else None
+
+    @classmethod
+    def states(cls, id_strs: list[str]) -> dict[str, str]:
+        """{id_str: state} of the id_strs that already have a job."""
+        return {
+            id_str: state for id_str, (state, _) in cls._states(id_strs).items()
+        }
+
+    @classmethod
+    def _states(cls, id_strs: list[str]) -> dict[str, tuple[str, str]]:
+        found = {}
+        for i in range(0, len(id_strs), MAX_VARIABLES):
+            chunk = id_strs[i : i + MAX_VARIABLES]
+            statement = (
+                f"SELECT id_str, state, profile FROM {cls.__name__} "
+                + f"WHERE id_str IN ({', '.join('?' * len(chunk))});"
+            )
+            for id_str, state, profile in get_db().execute(statement, chunk):
+                found[id_str] = (state, profile)
+        return found
+
+    @classmethod
+    def enqueue(
+        cls, features: list[Feature], profile: DownloadProfile = None
+    ) -> int:
+        """
+        Queue the products that have no job yet and the failed ones again.
+        Jobs whose profile doesn't cover profile get the union of both, done
+        ones are queued again (files already on disk are skipped). Returns
+        the number of newly queued or extended jobs.
+        """
+        profile_json = json.dumps(asdict(profile)) if profile is not None else ""
+        with transaction():
+            existing = cls._states([feature.id for feature in features])
+            new = [
+                cls(
+                    id_str=feature.id,
+                    s3_href=feature.product_s3_href,
+                    feature=feature.raw,
+                    profile=profile_json,
+                    updated=time.time(),
+                )
+                for feature in features
+                if feature.id not in existing
+            ]
+            cls.insert_many(new)
+            extended, retry = [], []
+            for id_str, (state, old_json) in existing.items():
+                changed = False
+                if old_json:
+                    old = DownloadProfile(**json.loads(old_json))
+                    merged = old.union(profile)
+                    if merged != old:
+                        changed = True
+                        merged_json = json.dumps(asdict(merged)) if merged else ""
+                        extended.append((merged_json, id_str))
+                if state == FAILED or (state == DONE and changed):
+                    retry.append((id_str,))
+            # A downloading job picks the new profile up in mark_done
+            get_db().executemany(
+                f"UPDATE {cls.__name__} SET profile=? WHERE id_str=?;", extended
+            )
+            get_db().executemany(
+                f"UPDATE {cls.__name__} SET state='{QUEUED}', attempts=0, "
+                + "next_attempt=0, error='' WHERE id_str=?;",
+                retry,
+            )
+        changed = {id_str for _, id_str in extended} | {id_str for id_str, in retry}
+        return len(new) + len(changed)
+
+    @classmethod
+    def claim(cls, worker: str) -> "IngestJob | None":
+        """The oldest due queued job, marked as downloading by worker."""
+        now = time.time()
+        with transaction(immediate=True):
+            statement = cls._select_statement(
+                None, cls.__name__, "state=? AND next_attempt<=?"
+            )
+            row = get_db().execute(
+                statement + " ORDER BY id LIMIT 1;", [QUEUED, now]
+            ).fetchone()
+            if row is None:
+                return None
+            job = cls._extract_row(row)
+            get_db().execute(
+                f"UPDATE {cls.__name__} SET state=?, worker=?, updated=? WHERE id=?;",
+                [DOWNLOADING, worker, now, job.id],
+            )
+        job.state, job.worker, job.updated = DOWNLOADING, worker, now
+        return job
+
+    @classmethod
+    def heartbeat(cls, id: int, bytes_done: int, bytes_total: int):
+        get_db().execute(
+            f"UPDATE {cls.__name__} SET bytes_done=?, bytes_total=?, updated=? "
+            + "WHERE id=?;",
+            [bytes_done, bytes_total, time.time(), id],
+        )
+        commit()
+
+    @classmethod
+    def mark_done(cls, id: int, profile: str):
+        """
+        Done, or queued again if enqueue extended the job's profile since it
+        was claimed with profile.
+        """
+        get_db().execute(
+            f"UPDATE {cls.__name__} "
+            + "SET state=CASE WHEN profile=? THEN ? ELSE ? END, error='', "
+            + "bytes_done=bytes_total, updated=? WHERE id=?;",
+            [profile, DONE, QUEUED, time.time(), id],
+        )
+        commit()
+
+    @classmethod
+    def mark_failed(cls, id: int, error: str, retry_at: float = None):
+        """Back to the queue until retry_at, or failed for good if None."""
+        state = FAILED if retry_at is None else QUEUED
+        get_db().execute(
+            f"UPDATE {cls.__name__} SET state=?, attempts=attempts+1, "
+            + "next_attempt=?, error=?, updated=? WHERE id=?;",
+            [state, retry_at or 0.0, error, time.time(), id],
+        )
+        commit()
+
+    @classmethod
+    def requeue(cls, workers: list[str] = None, stale_after: float = None) -> int:
+        """
+        Put downloading jobs back in the queue, those of the given workers
+        and/or those without a heartbeat for stale_after seconds.
+        """
+        where, values = [], []
+        if workers:
+            where.append(f"worker IN ({', '.join('?' * len(workers))})")
+            values += workers
+        if stale_after is not None:
+            where.append("updated<?")
+            values.append(time.time() - stale_after)
+        if not where:
+            return 0
+        cur = get_db().execute(
+            f"UPDATE {cls.__name__} SET state=? "
+            + f"WHERE state=? AND ({' OR '.join(where)});",
+            [QUEUED, DOWNLOADING, *values],
+        )
+        commit()
+        return cur.rowcount
+
+    @classmethod
+    def running_workers(cls) -> list[str]:
+        """Workers with a job in the downloading state."""
+        statement = f"SELECT DISTINCT worker FROM {cls.__name__} WHERE state=?;"
+        return [row[0] for row in get_db().execute(statement, [DOWNLOADING])]
+
+    @classmethod
+    def progress(cls) -> dict:
+        """Job counts per state and bytes of the running jobs, for the GUI."""
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(
+            get_db()
+            .execute(f"SELECT state, COUNT(*) FROM {cls.__name__} GROUP BY state;")
+            .fetchall()
+        )
+        bytes_done, bytes_total = get_db().execute(
+            f"SELECT SUM(bytes_done), SUM(bytes_total) FROM {cls.__name__} "
+            + "WHERE state=?;",
+            [DOWNLOADING],
+        ).fetchone()
+        return {
+            **counts,
+            "bytes_done": bytes_done or 0,
+            "bytes_total": bytes_total or 0,
+        }
+
+
+__all__ = [
+    IngestJob.__name__,
+]
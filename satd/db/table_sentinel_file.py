@@ -0,0 +1,62 @@
+from satd.db.table import (
+    Table,
+    get_db,
+    dataclass,
+    field,
+    transaction,
+    PRIMARY_KEY,
+    INDEX,
+)
+from satd.handles import invalidate_product
+
+
+@dataclass(kw_only=True)
+class SentinelFile(Table):
+    """A downloaded file of a SentinelImage product, path relative to .SAFE"""
+
+    id: int = field(default=-1, metadata={PRIMARY_KEY: True})
+    id_str: str = field(metadata={INDEX: True})
+    rel_path: str
+    # Empty for non band files (metadata etc.)
+    band: str = ""
+    resolution: str = ""
+    size: int
+    etag: str
+
+    @classmethod
+    def etags(cls, id_str: str) -> dict[str, str]:
+        statement = f"SELECT rel_path, etag FROM {cls.__name__} WHERE id_str=?;"
+        return dict(get_db().execute(statement, [id_str]).fetchall())
+
+    @classmethod
+    def record(cls, obj: "SentinelFile"):
+        """Insert obj, replacing any earlier row for the same file."""
+        statement = f"DELETE FROM {cls.__name__} WHERE id_str=? AND rel_path=?;"
+        with transaction():
+            get_db().execute(statement, [obj.id_str, obj.rel_path])
+            cls.insert(obj)
+        invalidate_product(obj.id_str)
+
+    @classmethod
+    def replace_product(cls, id_str: str, files: list["SentinelFile"]):
+        """Replace every recorded file of a product."""
+        with transaction():
+            cls.delete("id_str=?", [id_str])
+            cls.insert_many(files)
+        invalidate_product(id_str)
+
+    @classmethod
+    def select_band(
+        cls, id_str: str, band: str, suffix: str = ".jp2"
+    ) -> list["SentinelFile"]:
+        where = "id_str=? AND band=? AND rel_path LIKE ?"
+        return list(cls.iter_select(where=where, values=[id_str, band, "%" + suffix]))
+
+    @classmethod
+    def select_product(cls, id_str: str) -> list["SentinelFile"]:
+        return list(cls.iter_select(where="id_str=?", values=[id_str]))
+
+
+__all__ = [
+    SentinelFile.__name__,
+]
@@ -1,18 +1,25 @@
+import itertools
 import os
-from glob import glob
 import numpy as np
 
-from satd.db.geo_table import GeoTable, dataclass, Bbox
+from satd.db.geo_table import GeoTable, dataclass, field, Bbox, INDEX
+from satd.db.table import init_db, get_db
+from satd.db.table_sentinel_file import SentinelFile
 from satd.search import Feature
 import satd.raster as raster
+import satd.handles as handles
+import satd.footprint as footprints
+from satd.bands import RGB, cog_path, meters
 
 @dataclass(kw_only=True)
 class SentinelImage(GeoTable):
-    id_str: str
-    cloud_cover: float
-    datetime: str
+    id_str: str = field(metadata={INDEX: True})
+    cloud_cover: float = field(metadata={INDEX: True})
+    datetime: str = field(metadata={INDEX: True})
     product_type: str
     s3_href: str
+    # WKB lon/lat polygon of the data area, see satd.footprint
+    footprint: bytes = footprints.EMPTY
 
     @staticmethod
     def from_feature(feature: Feature):
@@ -30,34 +37,346 @@ class SentinelImage(GeoTable):
             datetime=data["properties"]["datetime"],
             product_type=data["properties"]["productType"],
             s3_href=data["assets"]["PRODUCT"]["alternate"]["s3"]["href"],
+            footprint=footprints.from_geojson(data.get("geometry")),
         )
 
+    @staticmethod
+    def polygons(images: list["SentinelImage"]) -> np.ndarray:
+        """Footprint polygons of the images (the bbox where there is none)."""
+        return footprints.to_polygons(
+            [image.footprint for image in images], [image.bbox for image in images]
+        )
+
+    @staticmethod
+    def coverage(images: list["SentinelImage"], aoi) -> np.ndarray:
+        """Percent of the AOI (bbox or shapely geometry) inside each footprint."""
+        return footprints.coverage(SentinelImage.polygons(images), aoi)
+
+    @staticmethod
+    def footprint_contains(images: list["SentinelImage"], lon, lat) -> np.ndarray:
+        """(len(images), len(lon)) bool, point inside the image's footprint."""
+        return footprints.contains_points(SentinelImage.polygons(images), lon, lat)
+
+    @staticmethod
+    def _filters(time_range=None, max_cloud=None, product_type=None):
+        where = []
+        values = []
+        if time_range is not None:
+            if isinstance(time_range, str):
+                time_range = time_range.split("/")
+            start, end = time_range
+            # '~' sorts after any ISO timestamp char, so a date-only end such
+            # as "2023-08-30" includes that whole day
+            where.append("datetime >= ? AND datetime <= ?")
+            values += [start, end + "~"]
+        if max_cloud is not None:
+            where.append("cloud_cover <= ?")
+            values.append(max_cloud)
+        if product_type is not None:
+            where.append("product_type = ?")
+            values.append(product_type)
+        return " AND ".join(where), values
+
+    @classmethod
+    def _filtered_bbox_query(
+        cls,
+        bbox,
+        time_range=None,
+        max_cloud=None,
+        product_type=None,
+        order_by="datetime DESC",
+        limit=None,
+    ):
+        where, values = cls._filters(time_range, max_cloud, product_type)
+        return cls._bbox_query(
+            bbox, where, values, order_by=order_by, limit=limit
+        )
+
+    @classmethod
+    def select_bbox(
+        cls,
+        bbox,
+        time_range: str | tuple[str, str] = None,
+        max_cloud: float = None,
+        product_type: str = None,
+        order_by: str = "datetime DESC",
+        limit: int = None,
+        min_coverage: float = None,
+    ) -> list["SentinelImage"]:
+        """
+        Images intersecting bbox, filtered on time range ("start/end" or a
+        tuple), cloud cover and product type in the same SQL query. With
+        min_coverage, only (the first limit) images whose footprint covers
+        at least that percent of bbox.
+        """
+        if min_coverage is None:
+            statement, values = cls._filtered_bbox_query(
+                bbox, time_range, max_cloud, product_type, order_by, limit
+            )
+            return cls._extract_rows(get_db().execute(statement, values).fetchall())
+        # The coverage test is not SQL, so the limit applies after it
+        statement, values = cls._filtered_bbox_query(
+            bbox, time_range, max_cloud, product_type, order_by
+        )
+        images = []
+        cur = get_db().execute(statement, values)
+        try:
+            while limit is None or len(images) < limit:
+                batch = cls._extract_rows(cur.fetchmany(max(limit or 0, 256)))
+                if not batch:
+                    break
+                keep = cls.coverage(batch, bbox) >= min_coverage
+                images += [image for image, ok in zip(batch, keep) if ok]
+        finally:
+            cur.close()
+        return images[:limit]
+
+    @classmethod
+    def select_point(cls, point) -> list["SentinelImage"]:
+        """Images whose footprint contains the (lon, lat) point."""
+        images = super().select_point(point)
+        if not images:
+            return images
+        x, y = point
+        inside = cls.footprint_contains(images, [x], [y])[:, 0]
+        return [image for image, ok in zip(images, inside) if ok]
+
+    @classmethod
+    def iter_select_point(
+        cls,
+        point,
+        columns: list[str] = None,
+        batch_size: int = 1000,
+        as_tuple: bool = False,
+    ):
+        """Streaming select_point, the same footprint test per batch."""
+        x, y = point
+        if columns is None and not as_tuple:
+            rows = super().iter_select_point(point, batch_size=batch_size)
+            while batch := list(itertools.islice(rows, batch_size)):
+                inside = cls.footprint_contains(batch, [x], [y])[:, 0]
+                yield from itertools.compress(batch, inside)
+            return
+        # Only the columns plus what the footprint test needs are selected
+        names = list(columns or cls.schema().names)
+        select = names + [name for name in ("bbox", "footprint") if name not in names]
+        bbox, footprint = select.index("bbox"), select.index("footprint")
+        rows = super().iter_select_point(point, select, batch_size, as_tuple=True)
+        while batch := list(itertools.islice(rows, batch_size)):
+            polygons = footprints.to_polygons(
+                [row[footprint] for row in batch], [row[bbox] for row in batch]
+            )
+            inside = footprints.contains_points(polygons, [x], [y])[:, 0]
+            for row in itertools.compress(batch, inside):
+                yield row[: len(names)]
+
+    @classmethod
+    def iter_select_point_arrays(
+        cls, point, columns: list[str] = None, batch_size: int = 10000
+    ):
+        x, y = point
+        names = list(columns or cls.schema().names)
+        select = names + [name for name in ("bbox", "footprint") if name not in names]
+        for arr in super().iter_select_point_arrays(point, select, batch_size):
+            polygons = footprints.to_polygons(list(arr["footprint"]), list(arr["bbox"]))
+            inside = footprints.contains_points(polygons, [x], [y])[:, 0]
+            yield arr[inside][names]
+
+    def _band_paths(self, dir_path: str, bands: tuple[str], prefer_cog: bool):
+        paths = []
+        for band in bands:
+            files = SentinelFile.select_band(self.id_str, band)
+            if not files:
+                break
+            file = min(files, key=lambda file: meters(file.resolution))
+            paths.append(os.path.join(dir_path, self.id_str, file.rel_path))
+        if len(paths) != len(bands) or not all(map(os.path.isfile, paths)):
+            return None
+        if prefer_cog:
+            paths = [
+                cog_path(path) if os.path.isfile(cog_path(path)) else path
+                for path in paths
+            ]
+        return paths
+
+    def band_paths(
+        self, dir_path: str, bands: list[str] = RGB, prefer_cog: bool = True
+    ) -> list[str] | None:
+        """
+        The finest resolution recorded file of each band (its COG if
+        converted), None unless every band is on disk. Cached per product
+        until SentinelFile.record changes its files. Products copied in or
+        downloaded before files were recorded need `satd index rebuild`.
+        """
+        key = (self.id_str, dir_path, tuple(bands), prefer_cog)
+        paths = handles.band_paths.get(
+            key, lambda: self._band_paths(dir_path, tuple(bands), prefer_cog)
+        )
+        return None if paths is None else list(paths)
+
+    def get_rgb_paths(self, dir_path: str, prefer_cog: bool = True) -> list[str]:
+        paths = self.band_paths(dir_path, RGB, prefer_cog)
+        if paths is None:
+            raise FileNotFoundError(
+                f"No recorded RGB band files of {self.id_str} in {dir_path}, "
+                + f"if the product is on disk run `satd index rebuild {dir_path}`"
+            )
+        return paths
+
     def get_rgb(self, dir_path: str, lev: int = 2) -> np.ndarray:
-        row_dir = os.path.join(dir_path, self.id_str)
-        imgs = sorted(glob(row_dir + "/GRANULE/*/IMG_DATA/*/*B0*_10m.jp2"))
-        rgb = list(reversed(imgs[:3]))
-        return raster.read_rgb(rgb, lev)
-    
+        # JP2 only, lev indexes the JP2 overviews
+        return raster.read_rgb(self.get_rgb_paths(dir_path, prefer_cog=False), lev)
+
     def get_rgb_photos(self, dir_path: str) -> list[raster.Photo]:
-        row_dir = os.path.join(dir_path, self.id_str)
-        imgs = sorted(glob(row_dir + "/GRANULE/*/IMG_DATA/*/*B0*_10m.jp2"))
-        rgb = list(reversed(imgs[:3]))
-        return [raster.Photo(path) for path in rgb]
+        return [raster.open_photo(path) for path in self.get_rgb_paths(dir_path)]
+
+    def band_math(self, expr: str, dir_path: str, resolution=None):
+        """BandMath of expr over the downloaded band files of this image."""
+        from satd.bandmath import BandMath, Expression
+
+        expr = Expression(expr)
+        paths = self.band_paths(dir_path, expr.bands) or []
+        return BandMath(expr, dict(zip(expr.bands, paths)), resolution)
+
+    def index(
+        self,
+        expr: str,
+        dir_path: str,
+        window: tuple[int, int, int, int] = None,
+        resolution=None,
+        block_size: int = 1024,
+    ) -> raster.Window:
+        """
+        Evaluate a band expression, e.g. "(B08-B04)/(B08+B04)" or "NDVI",
+        over a pixel window (x1, y1, x2, y2) of the target grid, whole tile
+        by default.
+        """
+        return self.band_math(expr, dir_path, resolution).read(window, block_size)
     
 __all__ = [
     SentinelImage.__name__,
 ]
 
+def _dummy_images(n):
+    return [
+        SentinelImage(
+            bbox=Bbox(14 + i % 4, 57, 16 + i % 4, 59),
+            id_str=f"a{i}",
+            cloud_cover=float(i % 100),
+            datetime=f"2023-06-{i % 30 + 1:02d}T10:10:21.024Z",
+            product_type="S2MSI2A",
+            s3_href=f"/eodata/a{i}.SAFE",
+        )
+        for i in range(n)
+    ]
+
+
+def _bench_insert(n=2000):
+    import tempfile
+    import time
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        init_db(os.path.join(tmp_dir, "row.db"))
+        SentinelImage.create_table()
+        t0 = time.perf_counter()
+        for row in _dummy_images(n):
+            SentinelImage.insert(row)
+        t_row = time.perf_counter() - t0
+
+        init_db(os.path.join(tmp_dir, "many.db"))
+        SentinelImage.create_table()
+        t0 = time.perf_counter()
+        SentinelImage.insert_many(_dummy_images(n))
+        t_many = time.perf_counter() - t0
+    print(f"insert:      {n / t_row:10.0f} rows/s")
+    print(f"insert_many: {n / t_many:10.0f} rows/s ({t_row / t_many:.0f}x)")
+
+
+def _bench_select(n=100_000):
+    import time
+
+    init_db(":memory:")
+    SentinelImage.create_table()
+    SentinelImage.insert_many(_dummy_images(n))
+    t0 = time.perf_counter()
+    rows = SentinelImage.select()
+    dt = time.perf_counter() - t0
+    print(f"select:      {len(rows) / dt:10.0f} rows/s")
+    t0 = time.perf_counter()
+    rows = SentinelImage.select_point((15, 58))
+    dt = time.perf_counter() - t0
+    print(f"select_point:{len(rows) / dt:10.0f} rows/s")
+
+
+def _check_query_plans():
+    init_db(":memory:")
+    SentinelImage.create_table()
+    SentinelImage.insert_many(_dummy_images(1000))
+    get_db().execute("ANALYZE;")
+
+    plan = SentinelImage.explain(
+        "SELECT 1 FROM SentinelImage WHERE id_str=? LIMIT 1;", ["a1"]
+    )
+    print("contains:", plan)
+    assert any("SentinelImage_id_str" in x for x in plan)
+
+    statement, values = SentinelImage._filtered_bbox_query(
+        (15, 58, 15.1, 58.1), time_range="2023-06-01/2023-06-02", max_cloud=10
+    )
+    plan = SentinelImage.explain(statement, values)
+    print("select_bbox:", plan)
+    assert any("SentinelImage_datetime" in x for x in plan)
+
+    statement, values = SentinelImage._filtered_bbox_query(
+        (15, 58, 15.1, 58.1), max_cloud=1, order_by=None
+    )
+    plan = SentinelImage.explain(statement, values)
+    print("select_bbox:", plan)
+    assert any("SentinelImage_cloud_cover" in x for x in plan)
+
+
+def _check_footprints():
+    init_db(":memory:")
+    SentinelImage.create_table()
+    images = _dummy_images(2)
+    # Swath edge: data only north-west of the bbox diagonal
+    images[1].footprint = footprints.from_lonlat([(15, 57), (15, 59), (17, 59)])
+    SentinelImage.insert_many(images)
+
+    # Inside both bboxes, outside the second footprint
+    found = SentinelImage.select_point((15.8, 57.2))
+    assert [image.id_str for image in found] == ["a0"], found
+    found = SentinelImage.select_point((15.2, 58.5))
+    assert sorted(image.id_str for image in found) == ["a0", "a1"], found
+
+    aoi = (15.5, 57.5, 16, 58.5)
+    covered = SentinelImage.coverage(SentinelImage.select_bbox(aoi), aoi)
+    print("coverage:", covered)
+    assert sorted(covered.round()) == [75, 100]
+    found = SentinelImage.select_bbox(aoi, min_coverage=80)
+    assert [image.id_str for image in found] == ["a0"], found
+    # a1 is newer but doesn't qualify, the limit applies after the test
+    found = SentinelImage.select_bbox(aoi, min_coverage=80, limit=1)
+    assert [image.id_str for image in found] == ["a0"], found
+
+    for point, expected in [((15.8, 57.2), ["a0"]), ((15.2, 58.5), ["a0", "a1"])]:
+        found = SentinelImage.iter_select_point(point, ["id_str"])
+        assert sorted(row[0] for row in found) == expected, point
+        found = SentinelImage.iter_select_point(point, batch_size=1)
+        assert sorted(image.id_str for image in found) == expected, point
+        arrays = SentinelImage.iter_select_point_arrays(point, ["id_str"])
+        assert sorted(x for arr in arrays for x in arr["id_str"]) == expected
+
+
 if __name__ == "__main__":
+    _check_query_plans()
+    _check_footprints()
+    init_db(":memory:")
     # init_db("/data/sentinel-2/index.db")
     SentinelImage.create_table()
-    # SentinelImage.insert_many(
-    #     [
-    #         SentinelImage(id_str="a0", date="2024-23", bbox=Bbox(0, 0, 2, 2)),
-    #         SentinelImage(id_str="a1", date="2024-12", bbox=Bbox(0, 0, 2, 2)),
-    #     ]
-    # )
-    SentinelImage.insert(SentinelImage(bbox=Bbox(0, 0, 4, 4)))
-    SentinelImage.insert(SentinelImage(bbox=Bbox(14, 57, 16, 59)))
+    ids = SentinelImage.insert_many(_dummy_images(2))
+    print("Inserted:", ids)
     print("Select all:\n", SentinelImage.select())
     print("Select (15, 58):\n", SentinelImage.select_point((15, 58)))
+    _bench_insert()
+    _bench_select()
@@ -0,0 +1,53 @@
+import json
+import time
+
+from satd.db.table import (
+    Table,
+    get_db,
+    commit,
+    dataclass,
+    field,
+    PRIMARY_KEY,
+    INDEX,
+)
+
+
+@dataclass(kw_only=True)
+class SyncState(Table):
+    """High-water mark of the catalogue sync of a named area of interest."""
+
+    id: int = field(default=-1, metadata={PRIMARY_KEY: True})
+    name: str = field(metadata={INDEX: True})
+    # json [min_x, min_y, max_x, max_y]
+    bbox: str
+    # Latest item datetime seen so far
+    high_water: str = ""
+    last_sync: float = 0.0
+    items: int = 0
+
+    @classmethod
+    def get(cls, name: str) -> "SyncState | None":
+        rows = list(cls.iter_select(where="name=?", values=[name]))
+        return rows[0] if rows else None
+
+    @classmethod
+    def save(cls, state: "SyncState") -> "SyncState":
+        state.last_sync = time.time()
+        if state.id == -1:
+            state.id = cls.insert(state)
+            return state
+        get_db().execute(
+            f"UPDATE {cls.__name__} SET bbox=?, high_water=?, last_sync=?, "
+            + "items=? WHERE id=?;",
+            [state.bbox, state.high_water, state.last_sync, state.items, state.id],
+        )
+        commit()
+        return state
+
+    def get_bbox(self) -> list[float]:
+        return json.loads(self.bbox)
+
+
+__all__ = [
+    SyncState.__name__,
+]
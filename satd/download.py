@@ -0,0 +1,348 @@
+"""
+Concurrent S3 downloads of .SAFE products.
+
+One boto3 client is shared by a bounded thread pool that downloads files from
+all requested products. Files are fetched as chunk_size ranged gets, up to
+max_concurrency of a file in flight, and appended in order to `.part`, so
+the `.part` of an interrupted file is always a prefix of it and is resumed
+from its size. Finished files are recorded in a manifest per product, so
+re-running skips them.
+
+A DownloadProfile filters the listing before transfer, and the files that
+were downloaded are recorded in the SentinelFile table, so asking for more
+bands later only transfers the missing ones.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from satd.bands import DownloadProfile, parse_band_file
+from satd.db.table_sentinel_file import SentinelFile
+
+MB = 1024 * 1024
+
+MANIFEST_NAME = ".satd_manifest.json"
+
+
+def make_s3_client(max_pool_connections: int = 32):
+    """S3 client for the endpoint in the environment (see .env)."""
+    session = boto3.session.Session()
+    return session.client(
+        "s3",
+        endpoint_url=os.environ["endpoint_url"],
+        aws_access_key_id=os.environ["aws_access_key_id"],
+        aws_secret_access_key=os.environ["aws_secret_access_key"],
+        region_name=os.environ["region_name"],
+        config=Config(max_pool_connections=max_pool_connections),
+    )
+
+
+def product_prefix(s3_href: str) -> str:
+    """'/eodata/Sentinel-2/.../X.SAFE' -> 'Sentinel-2/.../X.SAFE'"""
+    return s3_href.split("/eodata/")[1]
+
+
+def relative_path(key: str) -> str:
+    return key.split(".SAFE/")[1]
+
+
+class Progress:
+    """Thread safe byte/file counters, shared by all running transfers."""
+
+    def __init__(self, on_update=None, interval: float = 1.0):
+        self.lock = threading.Lock()
+        self.on_update = on_update
+        self.interval = interval
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.bytes_skipped = 0
+        self.files_total = 0
+        self.files_done = 0
+        self.started = time.perf_counter()
+        self.last_update = 0.0
+
+    def add_total(self, files: int, num_bytes: int):
+        with self.lock:
+            self.files_total += files
+            self.bytes_total += num_bytes
+
+    def add_bytes(self, num_bytes: int):
+        with self.lock:
+            self.bytes_done += num_bytes
+            now = time.perf_counter()
+            notify = now - self.last_update >= self.interval
+            if notify:
+                self.last_update = now
+        if notify and self.on_update:
+            self.on_update(self)
+
+    def file_done(self, skipped_bytes: int = 0):
+        with self.lock:
+            self.files_done += 1
+            self.bytes_skipped += skipped_bytes
+
+    def rate(self) -> float:
+        """Transferred bytes/s, skipped files not included."""
+        return self.bytes_done / max(time.perf_counter() - self.started, 1e-9)
+
+    def __str__(self):
+        done = (self.bytes_done + self.bytes_skipped) / MB
+        return (
+            f"{self.files_done}/{self.files_total} files, "
+            + f"{done:.1f}/{self.bytes_total / MB:.1f} MB, "
+            + f"{self.rate() / MB:.1f} MB/s"
+        )
+
+
+class Manifest:
+    """{relative path: {"size", "etag"}} of completed files in a product dir."""
+
+    def __init__(self, dst_dir: str):
+        self.path = os.path.join(dst_dir, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.files = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.files = json.load(f)
+
+    def is_complete(self, rel_path: str, dst_path: str, size: int, etag: str):
+        if not os.path.isfile(dst_path) or os.path.getsize(dst_path) != size:
+            return False
+        entry = self.files.get(rel_path)
+        # Files from before manifests existed are trusted on size alone
+        return entry is None or entry["etag"] == etag
+
+    def add(self, rel_path: str, size: int, etag: str):
+        with self.lock:
+            self.files[rel_path] = {"size": size, "etag": etag}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.files, f)
+            os.replace(tmp_path, self.path)
+
+
+class Downloader:
+    def __init__(
+        self,
+        dst_root: str,
+        client=None,
+        bucket: str = "eodata",
+        max_workers: int = 8,
+        chunk_size: int = 16 * MB,
+        max_concurrency: int = 4,
+        on_progress=None,
+        record: bool = True,
+    ):
+        self.dst_root = dst_root
+        self.record = record
+        self.client = client or make_s3_client(max_workers * max_concurrency)
+        self.bucket = bucket
+        self.chunk_size = chunk_size
+        self.max_concurrency = max_concurrency
+        # Separate from the file pool, file tasks wait on their chunks
+        self.chunk_pool = ThreadPoolExecutor(
+            max_workers * max_concurrency, thread_name_prefix="download-chunk"
+        )
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix="download")
+        self.progress = Progress(on_progress)
+
+    def list_files(self, prefix: str) -> list[dict]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        files = []
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            files += page.get("Contents", [])
+        return files
+
+    def _get_range(self, key: str, etag: str, start: int, end: int) -> bytes:
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=key, Range=f"bytes={start}-{end - 1}", IfMatch=etag
+        )
+        return response["Body"].read()
+
+    def _fetch(self, key: str, part_path: str, size: int, etag: str):
+        """Append the bytes of the object that part_path doesn't have yet."""
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        if offset > size:
+            offset = 0
+        pending = deque()
+        try:
+            with open(part_path, "ab" if offset else "wb") as f:
+                for start in range(offset, size, self.chunk_size):
+                    end = min(start + self.chunk_size, size)
+                    pending.append(
+                        self.chunk_pool.submit(self._get_range, key, etag, start, end)
+                    )
+                    if len(pending) >= self.max_concurrency:
+                        self._write(f, pending.popleft().result())
+                while pending:
+                    self._write(f, pending.popleft().result())
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("412", "PreconditionFailed"):
+                # Object changed since it was listed, the prefix is stale
+                os.remove(part_path)
+                raise RuntimeError(f"{key} changed during the download") from e
+            raise
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _write(self, f, data: bytes):
+        f.write(data)
+        # Flushed so an interruption leaves whole chunks in .part
+        f.flush()
+        self.progress.add_bytes(len(data))
+
+    def _download_file(self, obj: dict, dst_dir: str, manifest: Manifest) -> str:
+        key, size, etag = obj["Key"], obj["Size"], obj["ETag"]
+        rel_path = relative_path(key)
+        dst_path = os.path.join(dst_dir, rel_path)
+        if manifest.is_complete(rel_path, dst_path, size, etag):
+            self._record(dst_dir, rel_path, size, etag)
+            self.progress.file_done(skipped_bytes=size)
+            return dst_path
+
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        part_path = dst_path + ".part"
+        self._fetch(key, part_path, size, etag)
+        if os.path.getsize(part_path) != size:
+            raise IOError(f"{key}: got {os.path.getsize(part_path)} of {size} bytes")
+        os.replace(part_path, dst_path)
+        manifest.add(rel_path, size, etag)
+        self._record(dst_dir, rel_path, size, etag)
+        self.progress.file_done()
+        return dst_path
+
+    def _record(self, dst_dir: str, rel_path: str, size: int, etag: str):
+        if not self.record:
+            return
+        band, resolution = parse_band_file(rel_path) or ("", "")
+        SentinelFile.record(
+            SentinelFile(
+                id_str=os.path.basename(dst_dir),
+                rel_path=rel_path,
+                band=band,
+                resolution=resolution,
+                size=size,
+                etag=etag,
+            )
+        )
+
+    def _missing(self, id_str: str, dst_dir: str, files: list[dict]) -> list[dict]:
+        """Files not already recorded in the db with the same ETag."""
+        if not self.record:
+            return files
+        recorded = SentinelFile.etags(id_str)
+        missing = []
+        for obj in files:
+            rel_path = relative_path(obj["Key"])
+            dst_path = os.path.join(dst_dir, rel_path)
+            if recorded.get(rel_path) == obj["ETag"] and os.path.isfile(dst_path):
+                continue
+            missing.append(obj)
+        return missing
+
+    def submit_product(
+        self,
+        s3_href: str,
+        id_str: str,
+        profile: DownloadProfile = None,
+        files: list[dict] = None,
+    ):
+        """
+        Queue the files of a product selected by profile (all if None),
+        returns the futures.
+        """
+        prefix = product_prefix(s3_href)
+        if files is None:
+            files = self.list_files(prefix)
+        if not files:
+            raise FileNotFoundError(f"Could not find any files for {prefix}")
+        if profile is not None:
+            selected = profile.select([relative_path(obj["Key"]) for obj in files])
+            files = [obj for obj in files if relative_path(obj["Key"]) in selected]
+        dst_dir = os.path.join(self.dst_root, id_str)
+        files = self._missing(id_str, dst_dir, files)
+        os.makedirs(dst_dir, exist_ok=True)
+        manifest = Manifest(dst_dir)
+        self.progress.add_total(len(files), sum(obj["Size"] for obj in files))
+        return [
+            self.pool.submit(self._download_file, obj, dst_dir, manifest)
+            for obj in files
+        ]
+
+    def download_products(
+        self, products: list[tuple[str, str]], profile: DownloadProfile = None
+    ) -> list[str]:
+        """
+        Download (s3_href, id_str) products, files of all products share the
+        pool. Returns the local paths of the transferred files.
+        """
+        futures = []
+        for s3_href, id_str in products:
+            futures += self.submit_product(s3_href, id_str, profile)
+        return [future.result() for future in as_completed(futures)]
+
+    def download_product(
+        self, s3_href: str, id_str: str, profile: DownloadProfile = None
+    ) -> list[str]:
+        return self.download_products([(s3_href, id_str)], profile)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.chunk_pool.shutdown(wait=True)
+
+
+def _check_resume(size: int = 5 * MB + 123, chunk_size: int = MB):
+    """Interrupt a transfer (moto S3), then resume it from the .part."""
+    import tempfile
+
+    from moto import mock_aws
+
+    key = "Sentinel-2/MSI/L2A/X.SAFE/GRANULE/G/IMG_DATA/R10m/T_B04_10m.jp2"
+    data = os.urandom(size)
+    with mock_aws(), tempfile.TemporaryDirectory() as tmp_dir:
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="eodata")
+        client.put_object(Bucket="eodata", Key=key, Body=data)
+        downloader = Downloader(
+            tmp_dir, client, chunk_size=chunk_size, max_concurrency=2, record=False
+        )
+        get_range = downloader._get_range
+
+        def failing_get_range(key, etag, start, end):
+            if start >= 3 * chunk_size:
+                raise ConnectionError("interrupted")
+            return get_range(key, etag, start, end)
+
+        downloader._get_range = failing_get_range
+        try:
+            downloader.download_product("/eodata/Sentinel-2/MSI/L2A/X.SAFE", "X")
+            raise AssertionError("Expected the transfer to be interrupted")
+        except ConnectionError:
+            pass
+        dst_path = os.path.join(tmp_dir, "X", relative_path(key))
+        part_size = os.path.getsize(dst_path + ".part")
+        assert part_size == 3 * chunk_size, part_size
+
+        downloader._get_range = get_range
+        downloader.progress = Progress()
+        downloader.download_product("/eodata/Sentinel-2/MSI/L2A/X.SAFE", "X")
+        with open(dst_path, "rb") as f:
+            assert f.read() == data
+        assert not os.path.exists(dst_path + ".part")
+        # Only the missing bytes were transferred again
+        assert downloader.progress.bytes_done == size - part_size
+        downloader.close()
+    print("resume ok")
+
+
+if __name__ == "__main__":
+    _check_resume()
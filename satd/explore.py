@@ -1,19 +1,23 @@
 import dearpygui.dearpygui as dpg
 import numpy as np
-from PIL import Image
-from io import BytesIO
-import requests
 from pathlib import Path
 from satd.search import search, Feature
+from satd.bands import RGB_PROFILE
+from satd.quicklook import QuicklookCache
 import os
-import boto3
+import subprocess
+import sys
+import time
 from dotenv import load_dotenv
-import rasterio
 
 import satd.db as db
 
 load_dotenv()
 download_dir = "/data/sentinel-2"
+# Only what get_rgb needs, plus the cloud mask
+download_profile = RGB_PROFILE
+# Rewrite the RGB bands as COGs after download, faster window reads
+convert_to_cog = False
 
 
 WIDTH = 1920
@@ -22,58 +26,62 @@ HEIGHT = 1080
 PREVIEW_WIDTH = 512
 PREVIEW_HEIGHT = 512
 
-s3_session = boto3.session.Session()
+index_path = "/data/sentinel-2/index.db"
+# Worker processes of the ingest daemon (satd.ingest)
+ingest_workers = 2
 
-# in memory for now
+ingest_daemon: subprocess.Popen = None
 
-first = True
-def download(feature: Feature):
-    global first
-    if first:
-        db.init_db("/data/sentinel-2/index.db")
-        db.SentinelImage.create_table()
-        first = False
-
-    if db.SentinelImage.contains(feature.id, "id_str"):
-        print(f"{feature.id} already in db")
+def init_db():
+    db.init_db(index_path)
+    db.SentinelImage.create_table()
+    db.SentinelFile.create_table()
+    db.IngestJob.create_table()
+
+def start_ingest():
+    """The daemon runs outside the GUI process, jobs survive restarts of both."""
+    global ingest_daemon
+    if ingest_daemon is not None and ingest_daemon.poll() is None:
         return
-    else:
-        print(f"Adding {feature.id}")
-        row = db.SentinelImage.from_json(feature.data)
-        db.SentinelImage.insert(row)
-    product = feature.product_s3_href.split("/eodata/")[1]
-    s3 = boto3.resource(
-        "s3",
-        endpoint_url=os.environ["endpoint_url"],
-        aws_access_key_id=os.environ["aws_access_key_id"],
-        aws_secret_access_key=os.environ["aws_secret_access_key"],
-        region_name=os.environ["region_name"],
+    args = [sys.executable, "-m", "satd.ingest", index_path, download_dir]
+    args += ["--workers", str(ingest_workers)]
+    if convert_to_cog:
+        args.append("--cog")
+    ingest_daemon = subprocess.Popen(args)
+
+def stop_ingest():
+    if ingest_daemon is not None and ingest_daemon.poll() is None:
+        ingest_daemon.terminate()
+        ingest_daemon.wait()
+
+def download(feature: Feature):
+    download_many([feature])
+
+def download_many(features: list[Feature]):
+    """Queue the products, the SentinelImage rows are added when done."""
+    queued = db.IngestJob.enqueue(features, download_profile)
+    print(f"Queued {queued} of {len(features)} products")
+    start_ingest()
+
+def update_ingest_status():
+    p = db.IngestJob.progress()
+    mb = 1024 * 1024
+    dpg.set_value(
+        "ingest",
+        f"queued {p['queued']}, downloading {p['downloading']}, "
+        + f"done {p['done']}, failed {p['failed']}\n"
+        + f"{p['bytes_done'] / mb:.0f}/{p['bytes_total'] / mb:.0f} MB",
     )
-    bucket = s3.Bucket("eodata")
-    files = bucket.objects.filter(Prefix=product)
-    if not list(files):
-        raise FileNotFoundError(f"Could not find any files for {product}")
-    dst_dir = f"{download_dir}/{feature.id}"
-    for file in files:
-        rel_path = file.key.split(".SAFE/")[1]
-        dst_path = os.path.join(dst_dir, rel_path)
-        if not os.path.isdir(dst_path):
-            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
-            bucket.download_file(file.key, dst_path)
-        
-        # Bands meaning 02-04 = BGR 
-        # https://custom-scripts.sentinel-hub.com/custom-scripts/sentinel-2/bands/
-        if file.key.endswith(".jp2"):
-            print("Downloading to:", dst_path)
-    print("Download done!")
+
+init_db()
 
 dpg.create_context()
 
 
 class SearchVis:
     features: list[Feature] = []
-    imgs: list[np.ndarray] = []
     idx: int = 0
+    quicklooks = QuicklookCache(PREVIEW_WIDTH, PREVIEW_HEIGHT)
 
     def set_collection(self, features: list[Feature]):
 
@@ -87,16 +95,14 @@ class SearchVis:
                 continue
             self.features.append(feature)
         self.features.sort(reverse=True)
-        self.imgs = [None] * len(features)
+        self.idx = 0
         self.load()
 
     def download(self):
         download(self.features[self.idx])
 
     def download_all(self):
-        for i, feature in enumerate(self.features):
-            download(feature)
-            print(f"{i+1:02d}/{len(self.features):02d} downloaded..")
+        download_many(self.features)
 
 
     def load(self):
@@ -105,17 +111,25 @@ class SearchVis:
         feature = self.features[self.idx]
         dpg.set_value("idx", f"{self.idx + 1:02d}/{len(self.features):02d}")
         dpg.set_value("date", feature.datetime)
-        if self.imgs[self.idx] is None:
-            print("Fetching image...")
-            response = requests.get(feature.quicklook_href)
-            img = Image.open(BytesIO(response.content))
-            print("Done.")
-            img = img.resize((PREVIEW_WIDTH, PREVIEW_HEIGHT))
-            rgba = np.ones((PREVIEW_HEIGHT, PREVIEW_WIDTH, 4), np.float32)
-            rgb = np.array(img, dtype=np.float32) / 255.0
-            rgba[..., :3] = rgb
-            self.imgs[self.idx] = rgba
-        dpg.set_value("texture", self.imgs[self.idx])
+        urls = [f.quicklook_href for f in self.features]
+        self.quicklooks.prefetch(urls, self.idx)
+        if not feature.quicklook_href:
+            clear_preview()
+            return
+        # Shown when ready unless the user has moved on by then
+        idx = self.idx
+
+        def show(future):
+            if future.exception() is not None:
+                print(f"Quicklook of {feature.id} failed: {future.exception()!r}")
+            if self.idx != idx:
+                return
+            if future.exception() is None:
+                dpg.set_value("texture", future.result())
+            else:
+                clear_preview()
+
+        self.quicklooks.fetch(feature.quicklook_href).add_done_callback(show)
 
     def prev(self):
         self.idx = max(0, self.idx - 1)
@@ -126,6 +140,13 @@ class SearchVis:
         self.load()
 
 
+def clear_preview():
+    """Blank texture, not the quicklook of a previous date."""
+    dpg.set_value(
+        "texture", np.ones((PREVIEW_HEIGHT, PREVIEW_WIDTH, 4), dtype=np.float32)
+    )
+
+
 search_vis = SearchVis()
 
 
@@ -160,6 +181,7 @@ with dpg.window(
     dpg.add_text("", tag="date")
     dpg.add_button(label="Download", callback=search_vis.download)
     dpg.add_button(label="Download All", callback=search_vis.download_all)
+    dpg.add_text("", tag="ingest")
     dpg.add_image("texture")
 
 with dpg.window(label="Search", width=300, height=HEIGHT, pos=(0, 0)):
@@ -180,5 +202,12 @@ with dpg.handler_registry():
 dpg.create_viewport(width=WIDTH, height=HEIGHT, resizable=False)
 dpg.setup_dearpygui()
 dpg.show_viewport()
-dpg.start_dearpygui()
+# Poll the ingest queue about once a second between frames
+last_status = 0.0
+while dpg.is_dearpygui_running():
+    if time.monotonic() - last_status > 1.0:
+        update_ingest_status()
+        last_status = time.monotonic()
+    dpg.render_dearpygui_frame()
+stop_ingest()
 dpg.destroy_context()
@@ -0,0 +1,73 @@
+"""
+Scene footprints, the polygon of the actual data area in lon/lat.
+
+Sentinel-2 tiles at the edge of an orbit swath only have data on one side
+of a diagonal, so the bbox overlaps far more than the scene covers. The
+footprint is stored as WKB (SentinelImage.footprint), the rtree on the
+bbox prefilters queries and the exact tests run vectorised with shapely
+over all candidate scenes at once.
+
+Coverage is the percent of the AOI area inside the footprint, in lon/lat:
+over an AOI much smaller than a tile the distortion is the same on both
+sides of the ratio.
+"""
+
+import numpy as np
+import shapely
+
+EMPTY = b""
+
+
+def from_geojson(geometry: dict | None) -> bytes:
+    """WKB of a (STAC) GeoJSON geometry, EMPTY if there is none."""
+    if not geometry:
+        return EMPTY
+    return shapely.to_wkb(shapely.geometry.shape(geometry))
+
+
+def from_lonlat(points) -> bytes:
+    """WKB of the polygon with the (lon, lat) points as exterior ring."""
+    return shapely.to_wkb(shapely.Polygon(points))
+
+
+def to_polygons(footprints: list[bytes | None], bboxes) -> np.ndarray:
+    """
+    Shapely geometries of the footprints, the bbox for missing ones (rows
+    indexed before footprints were stored).
+    """
+    polygons = np.empty(len(footprints), dtype=object)
+    has_footprint = np.array([bool(x) for x in footprints], dtype=bool)
+    if has_footprint.any():
+        wkb = np.array(footprints, dtype=object)[has_footprint]
+        polygons[has_footprint] = shapely.from_wkb(wkb)
+    if not has_footprint.all():
+        boxes = np.array(bboxes, dtype=float).reshape(-1, 4)[~has_footprint]
+        polygons[~has_footprint] = shapely.box(*boxes.T)
+    return polygons
+
+
+def aoi_polygon(aoi) -> shapely.Geometry:
+    """A bbox (min_x, min_y, max_x, max_y) or any shapely geometry."""
+    if isinstance(aoi, shapely.Geometry):
+        return aoi
+    return shapely.box(*aoi)
+
+
+def coverage(polygons: np.ndarray, aoi) -> np.ndarray:
+    """Percent (0-100) of the AOI covered by each polygon."""
+    aoi = aoi_polygon(aoi)
+    if aoi.area == 0:
+        # Point or line AOI, covered or not
+        return 100.0 * shapely.intersects(polygons, aoi)
+    return 100.0 * shapely.area(shapely.intersection(polygons, aoi)) / aoi.area
+
+
+def contains_points(polygons: np.ndarray, xs, ys) -> np.ndarray:
+    """(len(polygons), len(xs)) bool, point inside (or on the edge of) polygon."""
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    out = np.zeros((len(polygons), len(xs)), dtype=bool)
+    for i, polygon in enumerate(polygons):
+        shapely.prepare(polygon)
+        out[i] = shapely.intersects_xy(polygon, xs, ys)
+    return out
@@ -0,0 +1,96 @@
+"""
+Bounded LRU caches of open raster handles and band path lookups.
+
+Opening a JP2 parses its codestream headers (tens of ms), and the explorer,
+tile server and compositor touch the same scenes over and over. GDAL
+handles must not be used from two threads at once, so raster keys its
+dataset and Photo caches by (path, thread).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class HandleCache:
+    """Thread safe LRU of at most max_items, with hit/miss/load statistics."""
+
+    def __init__(self, max_items: int = 128):
+        self.max_items = max_items
+        self.items: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def get(self, key, load):
+        """
+        The cached value of key, else load() is called (outside the lock).
+        None results are not cached, they usually mean "not there yet".
+        """
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+        t0 = time.perf_counter()
+        value = load()
+        dt = time.perf_counter() - t0
+        with self.lock:
+            self.load_seconds += dt
+            if value is None:
+                return None
+            # Loaded by another thread meanwhile, keep the first
+            value = self.items.setdefault(key, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, predicate=None):
+        """Drop the keys where predicate(key) is true, all keys if None."""
+        with self.lock:
+            if predicate is None:
+                self.items.clear()
+                return
+            for key in [key for key in self.items if predicate(key)]:
+                del self.items[key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / max(self.hits + self.misses, 1),
+                "mean_load_ms": 1000 * self.load_seconds / max(self.misses, 1),
+            }
+
+    def __str__(self):
+        s = self.stats()
+        return (
+            f"{s['size']}/{self.max_items} items, {s['hits']} hits, "
+            + f"{s['misses']} misses ({s['hit_rate']:.0%}), "
+            + f"{s['evictions']} evicted, {s['mean_load_ms']:.1f} ms/load"
+        )
+
+
+# (id_str, dir_path, bands, prefer_cog) -> band file paths, see
+# SentinelImage.band_paths. Invalidated per product by SentinelFile.record.
+band_paths = HandleCache(max_items=4096)
+
+
+def invalidate_product(id_str: str):
+    band_paths.invalidate(lambda key: key[0] == id_str)
@@ -0,0 +1,260 @@
+"""
+Background ingest of queued products.
+
+The explorer only queues products (IngestJob rows in the index db) and polls
+IngestJob.progress(). This daemon drains the queue with a few worker
+processes, each with its own Downloader: a worker claims the oldest due job,
+downloads it, then inserts the SentinelImage row and marks the job done in
+one transaction. Failures go back to the queue with exponential backoff
+until max_attempts. The queue lives in SQLite, so a restarted daemon picks
+up where the last one stopped, interrupted files are resumed from `.part`.
+
+    python -m satd.ingest /data/sentinel-2/index.db /data/sentinel-2 --workers 2
+"""
+
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+
+from satd.db.table import init_db, transaction
+from satd.db.table_ingest_job import IngestJob
+from satd.db.table_sentinel_file import SentinelFile
+from satd.db.table_sentinel_image import SentinelImage
+from satd.download import Downloader, Progress
+
+
+def backoff(attempts: int, base: float = 30.0, max_delay: float = 3600.0) -> float:
+    """Seconds to wait before retry number attempts + 1."""
+    return min(base * 2**attempts, max_delay)
+
+
+def pid_alive(pid: str) -> bool:
+    if os.name != "posix" or not pid.isdigit():
+        # Can't tell, left to the heartbeat
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def create_tables():
+    SentinelImage.create_table()
+    SentinelFile.create_table()
+    IngestJob.create_table()
+
+
+class Heartbeat:
+    """
+    Reports the progress of a running job every interval seconds, also while
+    a read stalls, so the daemon doesn't requeue a job that is still alive.
+    """
+
+    def __init__(self, job_id: int, progress: Progress, interval: float = 30.0):
+        self.job_id = job_id
+        self.progress = progress
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def beat(self):
+        progress = self.progress
+        done = progress.bytes_done + progress.bytes_skipped
+        IngestJob.heartbeat(self.job_id, done, progress.bytes_total)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.beat()
+            except sqlite3.Error as e:
+                print(f"Heartbeat of job {self.job_id} failed: {e}")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_job(
+    downloader: Downloader,
+    job: IngestJob,
+    max_attempts: int = 5,
+    convert_to_cog: bool = False,
+    heartbeat: float = 30.0,
+):
+    downloader.progress = Progress()
+    try:
+        with Heartbeat(job.id, downloader.progress, heartbeat):
+            downloader.download_product(
+                job.s3_href, job.id_str, job.download_profile()
+            )
+        image = SentinelImage.from_json(json.loads(job.feature))
+        with transaction():
+            if not SentinelImage.contains(job.id_str, "id_str"):
+                SentinelImage.insert(image)
+            IngestJob.mark_done(job.id, job.profile)
+    except Exception as e:
+        retry_at = None
+        if job.attempts + 1 < max_attempts:
+            retry_at = time.time() + backoff(job.attempts)
+        IngestJob.mark_failed(job.id, f"{type(e).__name__}: {e}", retry_at)
+        print(f"{job.id_str} failed ({job.attempts + 1}/{max_attempts}): {e}")
+        return
+    print(f"{job.id_str} done, {downloader.progress}")
+    if convert_to_cog:
+        import satd.cog as cog
+
+        # The bands are on disk and usable as JP2, the job stays done
+        try:
+            cog.convert_images([image], downloader.dst_root, workers=1)
+        except Exception as e:
+            print(f"{job.id_str} COG conversion failed: {type(e).__name__}: {e}")
+
+
+def worker_main(
+    db_path: str,
+    dst_root: str,
+    worker: str,
+    stop,
+    poll: float = 2.0,
+    max_attempts: int = 5,
+    convert_to_cog: bool = False,
+    downloader_kwargs: dict = None,
+):
+    # The daemon handles SIGINT and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_db(db_path)
+    downloader = Downloader(dst_root, **(downloader_kwargs or {}))
+    try:
+        while not stop.is_set():
+            job = IngestJob.claim(worker)
+            if job is None:
+                stop.wait(poll)
+                continue
+            run_job(downloader, job, max_attempts, convert_to_cog)
+    finally:
+        downloader.close()
+
+
+class IngestDaemon:
+    def __init__(
+        self,
+        db_path: str,
+        dst_root: str,
+        workers: int = 2,
+        stale_after: float = 600.0,
+        **worker_kwargs,
+    ):
+        self.db_path = db_path
+        self.dst_root = dst_root
+        self.num_workers = workers
+        self.stale_after = stale_after
+        self.worker_kwargs = worker_kwargs
+        # Spawned, GDAL and sqlite state must not be inherited with fork
+        self.ctx = multiprocessing.get_context("spawn")
+        self.stop_event = self.ctx.Event()
+        self.processes: dict[str, multiprocessing.Process] = {}
+
+    def start(self):
+        init_db(self.db_path)
+        create_tables()
+        # Jobs of a daemon that died without stopping its workers, right away
+        # if it ran on this host, else once their heartbeat is stale
+        host = socket.gethostname()
+        orphaned = [
+            worker
+            for worker in IngestJob.running_workers()
+            if worker.startswith(host + ":") and not pid_alive(worker.split(":")[1])
+        ]
+        requeued = IngestJob.requeue(workers=orphaned, stale_after=self.stale_after)
+        if requeued:
+            print(f"Requeued {requeued} stale jobs")
+        for i in range(self.num_workers):
+            self._spawn(f"{host}:{os.getpid()}:{i}")
+
+    def _spawn(self, name: str):
+        process = self.ctx.Process(
+            target=worker_main,
+            args=(self.db_path, self.dst_root, name, self.stop_event),
+            kwargs=self.worker_kwargs,
+            name=f"ingest-{name.rsplit(':', 1)[-1]}",
+        )
+        process.start()
+        self.processes[name] = process
+
+    def check_workers(self) -> list[str]:
+        """
+        Requeue the jobs of workers that died (segfault, OOM kill, ...) and
+        start new ones in their place, also requeue jobs without a heartbeat
+        for stale_after seconds. Returns the names of the restarted workers.
+        """
+        dead = [name for name, p in self.processes.items() if not p.is_alive()]
+        for name in dead:
+            self.processes[name].join()
+            requeued = IngestJob.requeue(workers=[name])
+            print(
+                f"Worker {name} died (exit code {self.processes[name].exitcode}), "
+                + f"requeued {requeued} jobs"
+            )
+            self._spawn(name)
+        IngestJob.requeue(stale_after=self.stale_after)
+        return dead
+
+    def stop(self, grace: float = 10.0):
+        """Stop after the running jobs, killing them after grace seconds."""
+        self.stop_event.set()
+        deadline = time.monotonic() + grace
+        for process in self.processes.values():
+            process.join(max(deadline - time.monotonic(), 0))
+        killed = [name for name, p in self.processes.items() if p.is_alive()]
+        for name in killed:
+            self.processes[name].terminate()
+            self.processes[name].join()
+        # Interrupted downloads resume from .part next time
+        IngestJob.requeue(workers=killed)
+        self.processes.clear()
+
+    def run_forever(self, interval: float = 10.0):
+        self.start()
+        try:
+            while True:
+                time.sleep(interval)
+                self.check_workers()
+                print(IngestJob.progress())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("db_path")
+    parser.add_argument("dst_root")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--max-attempts", type=int, default=5)
+    parser.add_argument("--cog", action="store_true", help="convert bands to COG")
+    args = parser.parse_args()
+
+    # SIGTERM (e.g. from the explorer on exit) stops like Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    IngestDaemon(
+        args.db_path,
+        args.dst_root,
+        args.workers,
+        max_attempts=args.max_attempts,
+        convert_to_cog=args.cog,
+    ).run_forever()
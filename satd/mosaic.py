@@ -0,0 +1,204 @@
+"""
+Mosaic of several scenes over an AOI.
+
+Every contributing scene is read only over its window of the AOI (at the
+overview level matching the output resolution) and warped into a shared
+output grid, by default the UTM zone of the AOI center, so AOIs crossing
+tile and zone boundaries come out whole. Scenes are composited first valid
+(nonzero) pixel wins, in an order given by the rule:
+
+    first         the order the images were passed in
+    latest        newest acquisition first
+    least_cloudy  lowest scene cloud cover first
+
+Scenes are read in parallel batches in that order, and reading stops as
+soon as every output pixel is filled.
+"""
+
+import math
+import os
+from dataclasses import dataclass
+
+import numpy as np
+from osgeo import gdal
+from pyproj import CRS
+from PIL import Image
+
+from satd.bands import RGB
+from satd.db.table_sentinel_image import SentinelImage
+from satd.raster import (
+    Photo,
+    Stretch,
+    Window,
+    default_stretch,
+    from_lonlat,
+    open_photo,
+    parallel_map,
+)
+
+gdal.UseExceptions()
+
+RULES = {
+    "first": None,
+    "latest": "datetime DESC",
+    "least_cloudy": "cloud_cover ASC",
+}
+
+
+def utm_crs(lon: float, lat: float) -> str:
+    zone = min(int((lon + 180) // 6) + 1, 60)
+    return f"EPSG:{(32600 if lat >= 0 else 32700) + zone}"
+
+
+@dataclass
+class Grid:
+    """Output pixel grid, north up."""
+
+    geo_transform: tuple
+    crs: str
+    xs: int
+    ys: int
+
+    @staticmethod
+    def for_bbox(bbox, resolution: float = 10.0, crs: str = None) -> "Grid":
+        """Grid of resolution meters covering the lon/lat bbox."""
+        min_x, min_y, max_x, max_y = bbox
+        crs = crs or utm_crs((min_x + max_x) / 2, (min_y + max_y) / 2)
+        e1, n1, e2, n2 = from_lonlat(crs).transform_bounds(min_x, min_y, max_x, max_y)
+        xs = max(math.ceil((e2 - e1) / resolution), 1)
+        ys = max(math.ceil((n2 - n1) / resolution), 1)
+        geo_transform = (e1, resolution, 0.0, n2, 0.0, -resolution)
+        return Grid(geo_transform, CRS.from_user_input(crs).to_wkt(), xs, ys)
+
+    @property
+    def resolution(self) -> float:
+        return abs(self.geo_transform[1])
+
+    def mem_dataset(self, dtype=gdal.GDT_UInt16) -> gdal.Dataset:
+        ds = gdal.GetDriverByName("MEM").Create("", self.xs, self.ys, 1, dtype)
+        ds.SetGeoTransform(self.geo_transform)
+        ds.SetProjection(self.crs)
+        return ds
+
+
+def scene_paths(
+    image: SentinelImage, dir_path: str, bands: list[str], prefer_cog: bool = True
+) -> list[str] | None:
+    """Band files of the scene, None unless every band is on disk."""
+    return image.band_paths(dir_path, bands, prefer_cog)
+
+
+def warp_photo(
+    photo: Photo,
+    bbox,
+    grid: Grid,
+    resample_alg: str = "bilinear",
+) -> np.ndarray | None:
+    """
+    The photo's data over bbox in the output grid (zeros outside the scene),
+    None if the photo doesn't overlap bbox.
+    """
+    x1, y1, x2, y2 = photo.pixel_window(*bbox)
+    if x2 - x1 <= 0 or y2 - y1 <= 0:
+        return None
+    # Read at about the output resolution, one extra pixel so bilinear warping
+    # has neighbours at the edges
+    pixel_size = abs(photo.geo_transform[1])
+    xs = math.ceil((x2 - x1) * pixel_size / grid.resolution) + 1
+    ys = math.ceil((y2 - y1) * pixel_size / grid.resolution) + 1
+    window = photo.read_window(x1, y1, x2, y2, xs, ys)
+    dst = grid.mem_dataset()
+    gdal.Warp(
+        dst,
+        window.to_mem_dataset(),
+        resampleAlg=resample_alg,
+        srcNodata=0,
+        dstNodata=0,
+    )
+    return dst.GetRasterBand(1).ReadAsArray()
+
+
+def read_scene(
+    image: SentinelImage,
+    dir_path: str,
+    bbox,
+    grid: Grid,
+    bands: list[str] = RGB,
+) -> np.ndarray | None:
+    """(ys, xs, C) bands of the scene in the grid, None if nothing to add."""
+    paths = scene_paths(image, dir_path, bands)
+    if paths is None:
+        return None
+    data = np.zeros((grid.ys, grid.xs, len(bands)), np.uint16)
+    for i, path in enumerate(paths):
+        band = warp_photo(open_photo(path), bbox, grid)
+        if band is None:
+            return None
+        data[..., i] = band
+    return data
+
+
+def mosaic_images(
+    images: list[SentinelImage],
+    dir_path: str,
+    bbox,
+    bands: list[str] = RGB,
+    rule: str = "first",
+    resolution: float = 10.0,
+    crs: str = None,
+    workers: int = None,
+) -> Window:
+    """Composite the images over the lon/lat bbox, see the module docstring."""
+    if rule == "latest":
+        images = sorted(images, key=lambda image: image.datetime, reverse=True)
+    elif rule == "least_cloudy":
+        images = sorted(images, key=lambda image: image.cloud_cover)
+    elif rule != "first":
+        raise ValueError(f"Unknown rule {rule!r}, expected one of {list(RULES)}")
+
+    grid = Grid.for_bbox(bbox, resolution, crs)
+    out = np.zeros((grid.ys, grid.xs, len(bands)), np.uint16)
+    filled = np.zeros((grid.ys, grid.xs), bool)
+    batch_size = workers or os.cpu_count()
+    read = lambda image: read_scene(image, dir_path, bbox, grid, bands)
+    for i in range(0, len(images), batch_size):
+        for data in parallel_map(read, images[i : i + batch_size], workers):
+            if data is None:
+                continue
+            new = ~filled & (data > 0).any(axis=-1)
+            out[new] = data[new]
+            filled |= new
+        if filled.all():
+            break
+    return Window(out, grid.geo_transform, grid.crs)
+
+
+def mosaic(
+    bbox,
+    dir_path: str,
+    time_range: str | tuple[str, str] = None,
+    max_cloud: float = None,
+    bands: list[str] = RGB,
+    rule: str = "latest",
+    min_coverage: float = None,
+    **kwargs,
+) -> Window:
+    """
+    Mosaic of the downloaded scenes intersecting bbox in time_range, those
+    covering less than min_coverage percent of bbox are left out.
+    """
+    images = SentinelImage.select_bbox(
+        bbox,
+        time_range,
+        max_cloud,
+        order_by=RULES.get(rule),
+        min_coverage=min_coverage,
+    )
+    return mosaic_images(images, dir_path, bbox, bands, rule, **kwargs)
+
+
+def to_image(window: Window, stretch: Stretch = default_stretch) -> Image.Image:
+    data = np.empty(window.data.shape, np.uint8)
+    for i in range(data.shape[2]):
+        stretch.apply(window.data[..., i], out=data[..., i])
+    return Image.fromarray(data)
@@ -0,0 +1,156 @@
+"""
+Quicklook thumbnails for the explorer.
+
+JPEG bytes are cached on disk by content hash (with a small url -> hash
+reference file), decoded RGBA textures are kept in an in-memory LRU with a
+byte budget, and fetching/decoding runs on a thread pool so the GUI thread
+never waits on the network.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import requests
+from PIL import Image
+
+MB = 1024 * 1024
+
+default_cache_dir = os.path.expanduser("~/.cache/satd/quicklook")
+
+
+class DiskCache:
+    """objects/<sha256 of bytes>.jpg, refs/<sha1 of url> -> sha256"""
+
+    def __init__(self, cache_dir: str = default_cache_dir):
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.refs_dir = os.path.join(cache_dir, "refs")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.refs_dir, exist_ok=True)
+
+    def _ref_path(self, url: str) -> str:
+        return os.path.join(self.refs_dir, hashlib.sha1(url.encode()).hexdigest())
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest + ".jpg")
+
+    def get(self, url: str) -> bytes | None:
+        try:
+            with open(self._ref_path(url)) as f:
+                digest = f.read().strip()
+            with open(self._object_path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, url: str, content: bytes):
+        digest = hashlib.sha256(content).hexdigest()
+        for path, data, mode in [
+            (self._object_path(digest), content, "wb"),
+            (self._ref_path(url), digest, "w"),
+        ]:
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, mode) as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+
+class TextureLRU:
+    """Decoded textures, least recently used evicted past max_bytes."""
+
+    def __init__(self, max_bytes: int = 256 * MB):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.items: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> np.ndarray | None:
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key: str, img: np.ndarray):
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self.items.pop(key).nbytes
+            self.items[key] = img
+            self.nbytes += img.nbytes
+            while self.nbytes > self.max_bytes and len(self.items) > 1:
+                _, old = self.items.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+
+def decode_rgba(content: bytes, width: int, height: int) -> np.ndarray:
+    img = Image.open(BytesIO(content)).convert("RGB")
+    img = img.resize((width, height))
+    rgba = np.ones((height, width, 4), np.float32)
+    np.multiply(np.asarray(img), 1.0 / 255.0, out=rgba[..., :3], casting="unsafe")
+    return rgba
+
+
+class QuicklookCache:
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        cache_dir: str = default_cache_dir,
+        max_bytes: int = 256 * MB,
+        max_workers: int = 4,
+        prefetch: int = 3,
+    ):
+        self.width = width
+        self.height = height
+        self.disk = DiskCache(cache_dir)
+        self.textures = TextureLRU(max_bytes)
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix="quicklook")
+        self.prefetch_count = prefetch
+        self.pending: dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+
+    def _load(self, url: str) -> np.ndarray:
+        try:
+            content = self.disk.get(url)
+            if content is None:
+                response = self.session.get(url, timeout=30)
+                response.raise_for_status()
+                content = response.content
+                self.disk.put(url, content)
+            img = decode_rgba(content, self.width, self.height)
+            self.textures.put(url, img)
+            return img
+        finally:
+            with self.lock:
+                self.pending.pop(url, None)
+
+    def fetch(self, url: str) -> Future:
+        """Future of the decoded texture, scheduled once per url."""
+        img = self.textures.get(url)
+        if img is not None:
+            future = Future()
+            future.set_result(img)
+            return future
+        with self.lock:
+            if url not in self.pending:
+                self.pending[url] = self.pool.submit(self._load, url)
+            return self.pending[url]
+
+    def get(self, url: str) -> np.ndarray | None:
+        """The texture if already decoded, else schedules it and returns None."""
+        img = self.textures.get(url)
+        if img is None:
+            self.fetch(url)
+        return img
+
+    def prefetch(self, urls: list[str], idx: int):
+        """Schedule the next/previous `prefetch` urls around idx."""
+        for offset in range(1, self.prefetch_count + 1):
+            for i in (idx + offset, idx - offset):
+                if 0 <= i < len(urls) and urls[i]:
+                    self.fetch(urls[i])
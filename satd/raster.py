@@ -3,24 +3,151 @@ Look at:
 https://github.com/langnico/global-canopy-height-model/blob/main/gchm/utils/gdal_process.py
 """
 
-import rasterio
-from osgeo import gdal
+from osgeo import gdal, gdal_array, osr
 from PIL import Image
 import numpy as np
-import utm
+from pyproj import Transformer
 from dataclasses import dataclass
+from functools import lru_cache
 import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from satd.handles import HandleCache
 
 gdal.UseExceptions()
 
 
-def normalize_uint8(data):
-    data = data.astype(np.float32)
-    data = data / (1 << 14)
-    data = np.clip(data * 255.0 / 0.3, a_min=0.0, a_max=255.0)
-    data = data.astype(np.uint8)
-    data = np.expand_dims(data, 2)
-    return data
+@dataclass(frozen=True)
+class Stretch:
+    """
+    Linear stretch of reflectance (DN / scale) from black..white to 0..255,
+    followed by an optional gamma. uint8/uint16 data goes through a 64K entry
+    lookup table, so no float copies of the band are made.
+    """
+
+    white: float = 0.3
+    black: float = 0.0
+    gamma: float = 1.0
+    scale: float = 1 << 14
+
+    @staticmethod
+    def from_percentiles(
+        data: np.ndarray,
+        low: float = 2.0,
+        high: float = 98.0,
+        gamma: float = 1.0,
+        scale: float = 1 << 14,
+    ) -> "Stretch":
+        """Black/white points at the low/high percentiles of a subsample."""
+        sample = data[::4, ::4].ravel()
+        counts = np.bincount(sample, minlength=1 << 16)
+        cdf = np.cumsum(counts) / max(sample.size, 1)
+        lo = np.searchsorted(cdf, low / 100.0)
+        hi = max(np.searchsorted(cdf, high / 100.0), lo + 1)
+        return Stretch(
+            white=float(hi / scale), black=float(lo / scale), gamma=gamma, scale=scale
+        )
+
+    def _stretch(self, data: np.ndarray) -> np.ndarray:
+        # Same float32 operations as the old normalize_uint8
+        data = data.astype(np.float32)
+        data = data / self.scale
+        data = np.clip(
+            (data - self.black) * 255.0 / (self.white - self.black),
+            a_min=0.0,
+            a_max=255.0,
+        )
+        if self.gamma != 1.0:
+            data = 255.0 * (data / 255.0) ** (1.0 / self.gamma)
+        return data.astype(np.uint8)
+
+    def lut(self) -> np.ndarray:
+        return _stretch_lut(self)
+
+    def apply(self, data: np.ndarray, out: np.ndarray = None, rows: int = 256):
+        """
+        Stretch data into out (allocated if None), which may be a strided
+        view such as the channel slot rgb[..., i].
+        """
+        if out is None:
+            out = np.empty(data.shape, np.uint8)
+        # A few rows at a time, np.take converts the indices to intp and the
+        # float path makes float32 temporaries
+        if data.dtype in (np.uint8, np.uint16):
+            lut = self.lut()
+            for y in range(0, data.shape[0], rows):
+                np.take(lut, data[y : y + rows], out=out[y : y + rows], mode="clip")
+            return out
+        for y in range(0, data.shape[0], rows):
+            out[y : y + rows] = self._stretch(data[y : y + rows])
+        return out
+
+
+@lru_cache(maxsize=32)
+def _stretch_lut(stretch: Stretch) -> np.ndarray:
+    return stretch._stretch(np.arange(1 << 16, dtype=np.uint16))
+
+
+default_stretch = Stretch()
+
+
+def normalize_uint8(data, stretch: Stretch = default_stretch):
+    return np.expand_dims(stretch.apply(data), 2)
+
+
+def apply_geo_transform(geo_transform: tuple, x, y):
+    """GDAL affine geo transform (rotation terms included) of scalars or arrays."""
+    g0, g1, g2, g3, g4, g5 = geo_transform
+    return g0 + x * g1 + y * g2, g3 + x * g4 + y * g5
+
+
+def invert_geo_transform(geo_transform: tuple) -> tuple:
+    g0, g1, g2, g3, g4, g5 = geo_transform
+    det = g1 * g5 - g2 * g4
+    if det == 0:
+        raise ValueError(f"Geo transform {geo_transform} is not invertible")
+    i1, i2, i4, i5 = g5 / det, -g2 / det, -g4 / det, g1 / det
+    return (-g0 * i1 - g3 * i2, i1, i2, -g0 * i4 - g3 * i5, i4, i5)
+
+
+# pyproj transformers are not safe to share between threads, so they are
+# cached per (crs, thread). Axis order is always lon, lat / east, north.
+@lru_cache(maxsize=256)
+def _transformer(src: str, dst: str, thread_id: int) -> Transformer:
+    return Transformer.from_crs(src, dst, always_xy=True)
+
+
+def from_lonlat(crs: str) -> Transformer:
+    return _transformer("EPSG:4326", crs, threading.get_ident())
+
+
+def to_lonlat(crs: str) -> Transformer:
+    return _transformer(crs, "EPSG:4326", threading.get_ident())
+
+
+@dataclass
+class Window:
+    """Raster data with the geo transform and CRS (WKT) of its pixels."""
+
+    data: np.ndarray
+    geo_transform: tuple
+    crs: str
+    # 0 = full resolution, i = overview i - 1
+    level: int = 0
+
+    def to_mem_dataset(self) -> gdal.Dataset:
+        ys, xs = self.data.shape[:2]
+        bands = 1 if self.data.ndim == 2 else self.data.shape[2]
+        dtype = gdal_array.NumericTypeCodeToGDALTypeCode(self.data.dtype)
+        ds = gdal.GetDriverByName("MEM").Create("", xs, ys, bands, dtype)
+        ds.SetGeoTransform(self.geo_transform)
+        ds.SetProjection(self.crs)
+        for i in range(bands):
+            band_data = self.data if self.data.ndim == 2 else self.data[..., i]
+            ds.GetRasterBand(i + 1).WriteArray(band_data)
+        return ds
 
 
 class Photo:
@@ -29,8 +156,37 @@ class Photo:
         self.cs: gdal.osr.SpatialReference = self.ds.GetSpatialRef()
         self.full_xs: int = self.ds.RasterXSize
         self.full_ys: int = self.ds.RasterYSize
-        self.zone_letter: str = self.cs.GetName()[-1]
-        self.zone_number: int = self.cs.GetUTMZone()
+        self.crs: str = self.cs.ExportToWkt()
+        self.geo_transform: tuple = self.ds.GetGeoTransform()
+        self.inv_geo_transform: tuple = invert_geo_transform(self.geo_transform)
+
+    def pixel_to_crs(self, x, y):
+        return apply_geo_transform(self.geo_transform, x, y)
+
+    def crs_to_pixel(self, east, north):
+        return apply_geo_transform(self.inv_geo_transform, east, north)
+
+    def pixel_to_lonlat(self, x, y):
+        """Full resolution pixel coordinates (scalars or arrays) to lon, lat."""
+        east, north = self.pixel_to_crs(x, y)
+        return to_lonlat(self.crs).transform(east, north)
+
+    def lonlat_to_pixel(self, lon, lat):
+        """lon, lat (scalars or arrays) to full resolution pixel coordinates."""
+        east, north = from_lonlat(self.crs).transform(lon, lat)
+        return self.crs_to_pixel(east, north)
+
+    def footprint(self) -> np.ndarray:
+        """(4, 2) lon/lat corners, clockwise from the top left."""
+        x = np.array([0, self.full_xs, self.full_xs, 0], np.float64)
+        y = np.array([0, 0, self.full_ys, self.full_ys], np.float64)
+        return np.stack(self.pixel_to_lonlat(x, y), axis=-1)
+
+    def lonlat_grid(self, step: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """(ys, xs) lon and lat of every step:th pixel center."""
+        x = np.arange(0, self.full_xs, step, dtype=np.float64) + 0.5
+        y = np.arange(0, self.full_ys, step, dtype=np.float64) + 0.5
+        return self.pixel_to_lonlat(*np.meshgrid(x, y))
 
     def get_geod_size(self):
         x0, y0 = self.get_geod_pos(0, 0)
@@ -38,11 +194,8 @@ class Photo:
         return abs(x1 - x0), abs(y1 - y0)
 
     def get_geod_pos(self, x, y):
-        east, x_east, x_north, north, y_east, y_north = self.ds.GetGeoTransform()
-        east += x_east * x
-        north += y_north * y
-        lat, lon = utm.to_latlon(east, north, self.zone_number, self.zone_letter)
-        return lon, lat
+        lon, lat = self.pixel_to_lonlat(x, y)
+        return float(lon), float(lat)
 
     def get_geod_center(self):
         return self.get_geod_pos(self.full_xs // 2, self.full_ys // 2)
@@ -57,70 +210,453 @@ class Photo:
             data = band.ReadAsArray()
         return normalize_uint8(data)
 
-    # Test by calling with const lon, lat, lon2, lat2
-    def read_aoi(self, lon1, lat1, lon2, lat2, xs, ys):
-        # Conv lat lon -> utm
-
-        tl_east, x_east, x_north, tl_north, y_east, y_north = self.ds.GetGeoTransform()
-        print(x_east, x_north)
-        print(lon1, lat1, lon2, lat2)
-        (e1, n1, *_) = utm.from_latlon(lat1, lon1)
-        (e2, n2, *_) = utm.from_latlon(lat2, lon2)
-        print(e1, n1, e2, n2)
-        clamp = lambda x, x_min, x_max: min(max(x, x_min), x_max)
-        x1 = math.floor((e1 - tl_east) / x_east)
-        y1 = math.floor((n1 - tl_north) / y_north)
-        x2 = math.ceil((e2 - tl_east) / x_east)
-        y2 = math.ceil((n2 - tl_north) / y_north)
-        x1 = clamp(x1, 0, self.full_xs - 1)
-        y1 = clamp(y1, 0, self.full_ys - 1)
-        x2 = clamp(x2, 0, self.full_xs - 1)
-        y2 = clamp(y2, 0, self.full_ys - 1)
-        window_xs = x2 - x1
-        window_ys = y2 - y1
-        if window_xs <= 0 or window_ys <= 0:
+    def levels(self) -> list[gdal.Band]:
+        """Full resolution band 1 followed by its overviews, finest first."""
+        band = self.ds.GetRasterBand(1)
+        return [band] + [band.GetOverview(i) for i in range(band.GetOverviewCount())]
+
+    def pick_level(self, window_xs: float, window_ys: float, xs: int, ys: int):
+        """
+        Coarsest level that still has at least xs x ys pixels over a window
+        of window_xs x window_ys full resolution pixels.
+        """
+        best = 0
+        for i, band in enumerate(self.levels()):
+            fx = self.full_xs / band.XSize
+            fy = self.full_ys / band.YSize
+            if window_xs / fx >= xs and window_ys / fy >= ys:
+                best = i
+        return best
+
+    def pixel_window(self, lon1, lat1, lon2, lat2):
+        """
+        Full resolution pixel window (x1, y1, x2, y2) covering the lon/lat box.
+        All four corners are transformed, the box is not a rectangle in UTM.
+        """
+        lon = np.array([lon1, lon2, lon2, lon1], np.float64)
+        lat = np.array([lat1, lat1, lat2, lat2], np.float64)
+        x, y = self.lonlat_to_pixel(lon, lat)
+        x1, x2 = np.clip([x.min(), x.max()], 0, self.full_xs)
+        y1, y2 = np.clip([y.min(), y.max()], 0, self.full_ys)
+        return float(x1), float(y1), float(x2), float(y2)
+
+    def read_window(
+        self,
+        x1: float,
+        y1: float,
+        x2: float,
+        y2: float,
+        xs: int,
+        ys: int,
+        align: bool = True,
+        resample_alg=gdal.GRIORA_Bilinear,
+    ) -> "Window":
+        """
+        Read the full resolution pixel window resampled to (ys, xs).
+
+        Reads from the coarsest overview that still has enough pixels and
+        lets GDAL resample while decoding. With align, the read is widened
+        to the level's internal blocks (1024x1024 for the S2 JP2s) and
+        cropped afterwards, so whole blocks are decoded and cached once.
+        Zoomed in past the level's resolution the read is not widened.
+        """
+        level = self.pick_level(x2 - x1, y2 - y1, xs, ys)
+        band = self.levels()[level]
+        fx = self.full_xs / band.XSize
+        fy = self.full_ys / band.YSize
+        # Window in level pixels, and output pixels per level pixel
+        lx1, lx2, ly1, ly2 = x1 / fx, x2 / fx, y1 / fy, y2 / fy
+        sx = xs / (lx2 - lx1)
+        sy = ys / (ly2 - ly1)
+        # Only when downsampling, padding an upsampled read would blow up the
+        # buffer (a 1024 block at 8x is a 8192x8192 buffer)
+        if align and sx <= 1 and sy <= 1:
+            bx, by = band.GetBlockSize()
+            ax1 = math.floor(lx1 / bx) * bx
+            ay1 = math.floor(ly1 / by) * by
+            ax2 = min(math.ceil(lx2 / bx) * bx, band.XSize)
+            ay2 = min(math.ceil(ly2 / by) * by, band.YSize)
+        else:
+            ax1, ay1 = math.floor(lx1), math.floor(ly1)
+            ax2 = min(math.ceil(lx2), band.XSize)
+            ay2 = min(math.ceil(ly2), band.YSize)
+        buf_xs = max(round((ax2 - ax1) * sx), xs)
+        buf_ys = max(round((ay2 - ay1) * sy), ys)
+        data = band.ReadAsArray(
+            ax1,
+            ay1,
+            ax2 - ax1,
+            ay2 - ay1,
+            buf_xsize=buf_xs,
+            buf_ysize=buf_ys,
+            resample_alg=resample_alg,
+        )
+        # Crop back to the requested window
+        ox = min(round((lx1 - ax1) * sx), buf_xs - xs)
+        oy = min(round((ly1 - ay1) * sy), buf_ys - ys)
+        data = data[oy : oy + ys, ox : ox + xs]
+
+        # Geo transform of the returned pixels
+        scale_x = (ax2 - ax1) * fx / buf_xs
+        scale_y = (ay2 - ay1) * fy / buf_ys
+        px = ax1 * fx + ox * scale_x
+        py = ay1 * fy + oy * scale_y
+        g0, g1, g2, g3, g4, g5 = self.geo_transform
+        geo_transform = (
+            g0 + px * g1 + py * g2,
+            g1 * scale_x,
+            g2 * scale_y,
+            g3 + px * g4 + py * g5,
+            g4 * scale_x,
+            g5 * scale_y,
+        )
+        return Window(data, geo_transform, self.crs, level)
+
+    def read_aoi_window(
+        self, lon1, lat1, lon2, lat2, xs, ys, align: bool = True
+    ) -> "Window | None":
+        x1, y1, x2, y2 = self.pixel_window(lon1, lat1, lon2, lat2)
+        if x2 - x1 <= 0 or y2 - y1 <= 0:
             print("Not in view")
-            return
+            return None
+        return self.read_window(x1, y1, x2, y2, xs, ys, align)
 
-        band: gdal.Band = self.ds.GetRasterBand(1)
-        # Construct np.array using xs, ys, send as 'buf_obj'
-        data = np.zeros((ys, xs), dtype=np.uint16)
-        band.ReadAsArray(x1, y1, window_xs, window_ys, buf_obj=data)
-        # data = np.flip(data, 0)
-        return normalize_uint8(data)
+    # Test by calling with const lon, lat, lon2, lat2
+    def read_aoi(
+        self, lon1, lat1, lon2, lat2, xs, ys, stretch: Stretch = default_stretch
+    ):
+        window = self.read_aoi_window(lon1, lat1, lon2, lat2, xs, ys)
+        if window is None:
+            return
+        return normalize_uint8(window.data, stretch)
 
     @staticmethod
-    def read_all_aoi(photos: list["Photo"], lon1, lat1, lon2, lat2, xs, ys):
-        data = []
-        for photo in photos:
-            data.append(photo.read_aoi(lon1, lat1, lon2, lat2, xs, ys))
-        data = np.concatenate(data, axis=2)
+    def read_all_aoi(
+        photos: list["Photo"],
+        lon1,
+        lat1,
+        lon2,
+        lat2,
+        xs,
+        ys,
+        workers: int = None,
+        stretch: Stretch = default_stretch,
+    ):
+        """One photo per channel, read in parallel into a (ys, xs, C) image."""
+        data = np.empty((ys, xs, len(photos)), np.uint8)
+
+        def read(i):
+            window = photos[i].read_aoi_window(lon1, lat1, lon2, lat2, xs, ys)
+            if window is None:
+                return False
+            stretch.apply(window.data, out=data[..., i])
+            return True
+
+        if not all(parallel_map(read, range(len(photos)), workers)):
+            return
         return Image.fromarray(data)
 
 
-def read_band(band_path, lev=2):
-    ds = gdal.Open(band_path)
+_pool: ThreadPoolExecutor = None
+_pool_workers: int = 0
+# Guards swapping _pool while other threads submit to it
+_pool_lock = threading.Lock()
+
+
+def _set_pool(workers: int):
+    global _pool, _pool_workers
+    with _pool_lock:
+        old = _pool
+        _pool = ThreadPoolExecutor(workers, thread_name_prefix="band")
+        _pool_workers = workers
+    if old is not None:
+        # Maps already submitted to the old pool still finish
+        old.shutdown(wait=False)
+
+
+def configure_threads(workers: int = None, gdal_threads: int = None):
+    """
+    Band reader pool size and GDAL_NUM_THREADS (decode threads per JP2 read).
+    By default the cores are split between the two to avoid oversubscription.
+    GDAL_NUM_THREADS is process wide, so it is only set here, not when
+    parallel_map creates the pool on first use.
+    """
+    workers = workers or os.cpu_count()
+    if gdal_threads is None:
+        gdal_threads = max(1, os.cpu_count() // workers)
+    gdal.SetConfigOption("GDAL_NUM_THREADS", str(gdal_threads))
+    _set_pool(workers)
+
+
+def parallel_map(fn, items, workers: int = None) -> list:
+    """
+    fn over items on the shared pool, or on a pool of its own for a workers
+    count other than the shared pool's.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None:
+            # Without touching GDAL_NUM_THREADS, see configure_threads
+            _pool_workers = os.cpu_count()
+            _pool = ThreadPoolExecutor(_pool_workers, thread_name_prefix="band")
+    if workers is not None and workers != _pool_workers:
+        with ThreadPoolExecutor(workers, thread_name_prefix="band") as pool:
+            return list(pool.map(fn, items))
+    with _pool_lock:
+        # map submits every item right away
+        results = _pool.map(fn, items)
+    return list(results)
+
+
+# Open handles per (path, thread), GDAL handles must not be shared
+datasets = HandleCache(max_items=256)
+photos = HandleCache(max_items=256)
+
+
+def thread_dataset(path: str) -> gdal.Dataset:
+    """A dataset per path and thread, from the bounded handle cache."""
+    return datasets.get((path, threading.get_ident()), lambda: gdal.Open(path))
+
+
+def open_photo(path: str) -> "Photo":
+    """A Photo per path and thread, from the bounded handle cache."""
+    return photos.get((path, threading.get_ident()), lambda: Photo(path))
+
+
+def band_level(ds: gdal.Dataset, lev: int) -> gdal.Band:
     band = ds.GetRasterBand(1)
+    return band.GetOverview(lev) if lev >= 0 else band
 
-    if lev >= 0:
-        ov = band.GetOverview(lev)
-        data = ov.ReadAsArray()
-    else:
-        data = band.ReadAsArray()
+
+def read_block(
+    path: str,
+    x0: int,
+    y0: int,
+    w: int,
+    h: int,
+    pixel_size: float,
+    resample_alg=gdal.GRIORA_Average,
+) -> np.ndarray:
+    """
+    (h, w) block of the pixel_size grid with the same origin as the band.
+    Coarser bands (20m, 60m on the 10m grid) are repeated, nearest neighbour
+    keeps class bands such as SCL exact. Finer bands are resampled by GDAL.
+    """
+    ds = thread_dataset(path)
+    band = ds.GetRasterBand(1)
+    band_size = abs(ds.GetGeoTransform()[1])
+    if band_size < pixel_size:
+        k = pixel_size / band_size
+        bx0, by0 = round(x0 * k), round(y0 * k)
+        bx1 = min(round((x0 + w) * k), ds.RasterXSize)
+        by1 = min(round((y0 + h) * k), ds.RasterYSize)
+        return band.ReadAsArray(
+            bx0,
+            by0,
+            bx1 - bx0,
+            by1 - by0,
+            buf_xsize=w,
+            buf_ysize=h,
+            resample_alg=resample_alg,
+        )
+    f = round(band_size / pixel_size)
+    if f == 1:
+        return band.ReadAsArray(x0, y0, w, h)
+    sx0, sy0 = x0 // f, y0 // f
+    sx1 = min(math.ceil((x0 + w) / f), ds.RasterXSize)
+    sy1 = min(math.ceil((y0 + h) / f), ds.RasterYSize)
+    data = band.ReadAsArray(sx0, sy0, sx1 - sx0, sy1 - sy0)
+    data = data.repeat(f, axis=0).repeat(f, axis=1)
+    ox, oy = x0 - sx0 * f, y0 - sy0 * f
+    return data[oy : oy + h, ox : ox + w]
+
+
+def blocks(x1: int, y1: int, x2: int, y2: int, block_size: int):
+    """Blocks (x0, y0, w, h) of the window, aligned to the block_size grid."""
+    for y0 in range(y1 - y1 % block_size, y2, block_size):
+        for x0 in range(x1 - x1 % block_size, x2, block_size):
+            bx0, by0 = max(x0, x1), max(y0, y1)
+            bx1, by1 = min(x0 + block_size, x2), min(y0 + block_size, y2)
+            yield bx0, by0, bx1 - bx0, by1 - by0
+
+
+def read_band(band_path, lev=2):
+    data = band_level(thread_dataset(band_path), lev).ReadAsArray()
     data = np.flip(data, 0)
     return normalize_uint8(data)
 
 
-def read_rgb(rgb_paths, lev=2):
-    rgbs = [read_band(path) for path in rgb_paths]
-    rgb = np.concatenate(rgbs, axis=2)
+def read_rgb(
+    rgb_paths, lev=2, workers: int = None, stretch: Stretch = default_stretch
+):
+    """Read the bands in parallel straight into one (H, W, C) array."""
+    band = band_level(thread_dataset(rgb_paths[0]), lev)
+    rgb = np.empty((band.YSize, band.XSize, len(rgb_paths)), np.uint8)
+
+    def read(i):
+        data = band_level(thread_dataset(rgb_paths[i]), lev).ReadAsArray()
+        stretch.apply(np.flip(data, 0), out=rgb[..., i])
+
+    parallel_map(read, range(len(rgb_paths)), workers)
     return rgb
 
 
+def make_synthetic(path: str, size: int = 10980):
+    """Synthetic UInt16 band on the T33VWE grid, JP2 or COG by extension."""
+    ds = gdal.GetDriverByName("MEM").Create("", size, size, 1, gdal.GDT_UInt16)
+    ds.SetGeoTransform((499980.0, 10.0, 0.0, 6500040.0, 0.0, -10.0))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32633)
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    x = np.arange(size, dtype=np.uint32)
+    for y0 in range(0, size, 1024):
+        y = np.arange(y0, min(y0 + 1024, size), dtype=np.uint32)[:, None]
+        band.WriteArray(((x * 3 + y * 2) % 4096 + 100).astype(np.uint16), 0, y0)
+    if path.endswith(".jp2"):
+        driver = "JP2OpenJPEG"
+        options = ["BLOCKXSIZE=1024", "BLOCKYSIZE=1024", "RESOLUTIONS=5"]
+        options += ["REVERSIBLE=YES", "QUALITY=100"]
+    else:
+        driver = "COG"
+        options = ["BLOCKSIZE=1024", "COMPRESS=ZSTD", "OVERVIEWS=AUTO"]
+    gdal.GetDriverByName(driver).CreateCopy(path, ds, options=options)
+
+
+def _bench_read_aoi(path: str = None, xs: int = 512, ys: int = 512, repeat: int = 5):
+    import tempfile
+    import time
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if path is None:
+            path = os.path.join(tmp_dir, "synthetic.jp2")
+            make_synthetic(path)
+        photo = Photo(path)
+        lon, lat = photo.get_geod_center()
+        # Half width of the AOI in degrees, ~1 km to ~90 km
+        for half in [0.01, 0.05, 0.2, 0.8]:
+            aoi = (lon - half, lat - half / 2, lon + half, lat + half / 2)
+            for align in [False, True]:
+                t0 = time.perf_counter()
+                for _ in range(repeat):
+                    window = photo.read_aoi_window(*aoi, xs, ys, align=align)
+                dt = (time.perf_counter() - t0) / repeat
+                print(
+                    f"half={half:5.2f} deg level={window.level} align={align!s:5} "
+                    + f"{dt * 1000:8.1f} ms"
+                )
+            # The old behaviour: full resolution, unaligned
+            x1, y1, x2, y2 = photo.pixel_window(*aoi)
+            band = photo.ds.GetRasterBand(1)
+            t0 = time.perf_counter()
+            band.ReadAsArray(
+                math.floor(x1),
+                math.floor(y1),
+                math.ceil(x2) - math.floor(x1),
+                math.ceil(y2) - math.floor(y1),
+                buf_xsize=xs,
+                buf_ysize=ys,
+            )
+            dt = time.perf_counter() - t0
+            print(f"half={half:5.2f} deg full resolution       {dt * 1000:8.1f} ms")
+
+
+def _bench_stretch(size: int = 10980, repeat: int = 3):
+    import time
+    import tracemalloc
+
+    def old_normalize_uint8(data):
+        data = data.astype(np.float32)
+        data = data / (1 << 14)
+        data = np.clip(data * 255.0 / 0.3, a_min=0.0, a_max=255.0)
+        data = data.astype(np.uint8)
+        return np.expand_dims(data, 2)
+
+    band = np.random.default_rng(0).integers(0, 1 << 15, (size, size), np.uint16)
+    rgb = np.empty((size, size, 3), np.uint8)
+    default_stretch.lut()
+    assert (old_normalize_uint8(band)[..., 0] == default_stretch.apply(band)).all()
+
+    runs = [
+        ("normalize_uint8 (old)", lambda: old_normalize_uint8(band)),
+        (
+            "Stretch.apply -> rgb[..., 0]",
+            lambda: default_stretch.apply(band, rgb[..., 0]),
+        ),
+    ]
+    mpix = size * size / 1e6
+    for name, fn in runs:
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        dt = (time.perf_counter() - t0) / repeat
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:30s} {mpix / dt:8.1f} Mpix/s, peak {peak / 2**20:8.1f} MB")
+
+
+def _bench_bands(path: str = None, num_bands: int = 12, lev: int = -1):
+    import tempfile
+    import time
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if path is None:
+            path = os.path.join(tmp_dir, "synthetic.jp2")
+            make_synthetic(path)
+        # Same file per band, each thread still opens its own handle
+        paths = [path] * num_bands
+        workers = 1
+        while workers <= os.cpu_count():
+            configure_threads(workers)
+            datasets.invalidate()
+            t0 = time.perf_counter()
+            read_rgb(paths, lev)
+            dt = time.perf_counter() - t0
+            print(f"{num_bands} bands, {workers:2d} workers: {dt:6.2f} s")
+            workers *= 2
+
+
+
+def _bench_handles(path: str = None, repeat: int = 100):
+    import tempfile
+    import time
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if path is None:
+            path = os.path.join(tmp_dir, "synthetic.jp2")
+            make_synthetic(path)
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            Photo(path)
+        dt_open = (time.perf_counter() - t0) / repeat
+        photos.invalidate()
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            open_photo(path)
+        dt_cached = (time.perf_counter() - t0) / repeat
+        print(f"Photo():      {dt_open * 1000:8.3f} ms")
+        print(f"open_photo(): {dt_cached * 1000:8.3f} ms ({photos})")
+
+
 if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:2] == ["bench"]:
+        _bench_read_aoi(*sys.argv[2:3])
+        sys.exit()
+    if sys.argv[1:2] == ["bench_handles"]:
+        _bench_handles(*sys.argv[2:3])
+        sys.exit()
+    if sys.argv[1:2] == ["bench_stretch"]:
+        _bench_stretch()
+        sys.exit()
+    if sys.argv[1:2] == ["bench_bands"]:
+        _bench_bands(*sys.argv[2:3])
+        sys.exit()
     directory = "Sentinel-2/MSI/L2A/2023/06/15/S2A_MSIL2A_20230615T102031_N0509_R065_T33VWE_20230615T193401.SAFE/GRANULE/L2A_T33VWE_A041675_20230615T102026/IMG_DATA/R10m"
     path = directory + "/T33VWE_20230615T102031_B{:02d}_10m.jp2"
-    rgb = read_rgb(path.format(4), path.format(3), path.format(2))
+    rgb = read_rgb([path.format(4), path.format(3), path.format(2)])
     img = Image.fromarray(rgb)
     # png takes such a long time
     img.save("resources/images/tmp.jpg")
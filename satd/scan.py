@@ -0,0 +1,203 @@
+"""
+Index products that are already on disk (copied in, or downloaded before
+files were recorded).
+
+Product directories are scanned in a process pool: each worker parses the
+product metadata (MTD_MSIL2A.xml / MTD_MSIL1C.xml) for datetime, cloud
+cover and footprint and lists the files with their sizes (ETags from the
+download manifest when there is one). The results are bulk upserted,
+SentinelImage rows and the SentinelFile rows of each product, in one
+transaction per batch.
+
+    satd index rebuild /data/sentinel-2
+"""
+
+import json
+import multiprocessing
+import os
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+from satd.bands import parse_band_file
+from satd.db.geo_table import Bbox
+from satd.db.table import MAX_VARIABLES, get_db, init_db, transaction
+from satd.db.table_sentinel_file import SentinelFile
+from satd.db.table_sentinel_image import SentinelImage
+from satd.download import MANIFEST_NAME
+import satd.footprint as footprints
+
+METADATA_FILES = ["MTD_MSIL2A.xml", "MTD_MSIL1C.xml"]
+
+# Local (namespace free) tag -> key
+METADATA_TAGS = {
+    "PRODUCT_START_TIME": "datetime",
+    "PRODUCT_URI": "product_uri",
+    "PRODUCT_TYPE": "product_type",
+    "EXT_POS_LIST": "footprint",
+    "Cloud_Coverage_Assessment": "cloud_cover",
+}
+
+
+def parse_metadata(path: str) -> dict:
+    """The METADATA_TAGS values of a product metadata file."""
+    found = {}
+    for _, elem in ET.iterparse(path):
+        tag = elem.tag.rsplit("}", 1)[-1]
+        key = METADATA_TAGS.get(tag)
+        # The first of each, granule footprints etc. come later
+        if key is not None and key not in found:
+            found[key] = (elem.text or "").strip()
+            if len(found) == len(METADATA_TAGS):
+                break
+        elem.clear()
+    missing = set(METADATA_TAGS.values()) - set(found)
+    if missing:
+        raise ValueError(f"{path} has no {sorted(missing)}")
+    return found
+
+
+def footprint_lonlat(pos_list: str) -> list[tuple[float, float]]:
+    """EXT_POS_LIST "lat lon lat lon ..." -> [(lon, lat), ...]"""
+    values = [float(x) for x in pos_list.split()]
+    return list(zip(values[1::2], values[0::2]))
+
+
+def s3_href(product_uri: str, product_type: str, datetime: str) -> str:
+    """Where the product is on the CDSE eodata bucket."""
+    level = "L2A" if product_type.endswith("2A") else "L1C"
+    date = datetime[:10].replace("-", "/")
+    return f"/eodata/Sentinel-2/MSI/{level}/{date}/{product_uri}"
+
+
+def metadata_path(product_dir: str) -> str | None:
+    for name in METADATA_FILES:
+        path = os.path.join(product_dir, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def find_products(root: str) -> list[str]:
+    """Product directories directly under root."""
+    with os.scandir(root) as entries:
+        return sorted(
+            entry.path
+            for entry in entries
+            if entry.is_dir() and metadata_path(entry.path) is not None
+        )
+
+
+def scan_product(product_dir: str) -> tuple[SentinelImage, list[SentinelFile]]:
+    """The image row and files of one product, runs in the worker processes."""
+    id_str = os.path.basename(product_dir.rstrip(os.sep))
+    meta = parse_metadata(metadata_path(product_dir))
+    points = footprint_lonlat(meta["footprint"])
+    lons = [lon for lon, _ in points]
+    lats = [lat for _, lat in points]
+    image = SentinelImage(
+        bbox=Bbox(min(lons), min(lats), max(lons), max(lats)),
+        id_str=id_str,
+        cloud_cover=float(meta["cloud_cover"]),
+        datetime=meta["datetime"],
+        product_type=meta["product_type"],
+        s3_href=s3_href(meta["product_uri"], meta["product_type"], meta["datetime"]),
+        footprint=footprints.from_lonlat(points),
+    )
+
+    etags = {}
+    manifest_path = os.path.join(product_dir, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            etags = {path: entry["etag"] for path, entry in json.load(f).items()}
+    files = []
+    for dir_path, _, names in os.walk(product_dir):
+        for name in names:
+            if name == MANIFEST_NAME or name.endswith((".part", ".tmp.tif")):
+                continue
+            path = os.path.join(dir_path, name)
+            rel_path = os.path.relpath(path, product_dir).replace(os.sep, "/")
+            band, resolution = parse_band_file(rel_path) or ("", "")
+            files.append(
+                SentinelFile(
+                    id_str=id_str,
+                    rel_path=rel_path,
+                    band=band,
+                    resolution=resolution,
+                    size=os.path.getsize(path),
+                    etag=etags.get(rel_path, ""),
+                )
+            )
+    return image, files
+
+
+def upsert(results: list[tuple[SentinelImage, list[SentinelFile]]]):
+    """Replace the image rows and recorded files of the scanned products."""
+    images = [image for image, _ in results]
+    with transaction():
+        for i in range(0, len(images), MAX_VARIABLES):
+            chunk = [image.id_str for image in images[i : i + MAX_VARIABLES]]
+            where = f"id_str IN ({', '.join('?' * len(chunk))})"
+            SentinelImage.delete(where, chunk)
+        SentinelImage.insert_many(images)
+        for image, files in results:
+            SentinelFile.replace_product(image.id_str, files)
+
+
+def prune(keep: set[str]) -> int:
+    """
+    Delete the rows of products with recorded files that are not in keep.
+    Catalogue only rows (satd.sync) have no files and stay.
+    """
+    statement = f"SELECT DISTINCT id_str FROM {SentinelFile.__name__};"
+    rows = get_db().execute(statement).fetchall()
+    gone = [id_str for id_str, in rows if id_str not in keep]
+    with transaction():
+        for id_str in gone:
+            SentinelImage.delete("id_str=?", [id_str])
+            SentinelFile.replace_product(id_str, [])
+    return len(gone)
+
+
+def rebuild(
+    root: str,
+    workers: int = None,
+    batch_size: int = 256,
+    remove_missing: bool = False,
+) -> int:
+    """Scan every product under root into the current database."""
+    SentinelImage.create_table()
+    SentinelFile.create_table()
+    t0 = time.perf_counter()
+    product_dirs = find_products(root)
+    done, failed = 0, []
+    # Spawned, the parent's sqlite connections must not be inherited
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(workers, mp_context=spawn) as pool:
+        futures = [pool.submit(scan_product, path) for path in product_dirs]
+        batch = []
+        for path, future in zip(product_dirs, futures):
+            try:
+                batch.append(future.result())
+            except Exception as e:
+                failed.append(path)
+                print(f"Skipping {path}: {e}")
+            if len(batch) >= batch_size:
+                upsert(batch)
+                done += len(batch)
+                batch = []
+        upsert(batch)
+        done += len(batch)
+    removed = 0
+    if remove_missing:
+        removed = prune({os.path.basename(path) for path in product_dirs})
+    print(
+        f"Indexed {done} products ({len(failed)} failed, {removed} removed) "
+        + f"in {time.perf_counter() - t0:.1f} s"
+    )
+    return done
+
+
+def main(args):
+    init_db(args.db or os.path.join(args.dir, "index.db"))
+    rebuild(args.dir, args.workers, remove_missing=args.prune)
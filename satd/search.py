@@ -1,26 +1,79 @@
 ## https://documentation.dataspace.copernicus.eu/APIs/STAC.html
 
-import requests
+import asyncio
+import hashlib
+import io
 import json
+import math
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
 
 # Define the correct API endpoint for STAC
 stac_endpoint = "https://catalogue.dataspace.copernicus.eu/stac/collections"
+default_cache_dir = os.path.expanduser("~/.cache/satd/stac")
 
 
 class Feature:
-    def __init__(self, data):
-        self.data = data
+    """
+    The fields used for filtering/downloading, extracted up front. The rest
+    of the STAC item is kept as its JSON text and only parsed on access.
+    """
+
+    __slots__ = (
+        "id",
+        "datetime",
+        "cloud_cover",
+        "product_type",
+        "is_2a",
+        "quicklook_href",
+        "product_s3_href",
+        "_raw",
+        "_data",
+    )
+
+    def __init__(self, data: dict, raw: str = None):
         self.id = data["id"]
-        self.properties = self.data["properties"]
-        self.datetime = self.properties["datetime"]
-        self.cloud_cover = self.properties["cloudCover"]
-        self.is_2a = self.properties["productType"].endswith("2A")
+        properties = data["properties"]
+        self.datetime = properties["datetime"]
+        self.cloud_cover = properties["cloudCover"]
+        self.product_type = properties["productType"]
+        self.is_2a = self.product_type.endswith("2A")
         self.quicklook_href = ""
-        if "QUICKLOOK" in self.data["assets"]:
-            self.quicklook_href = self.data["assets"]["QUICKLOOK"]["href"]
-        self.product = self.data["assets"]["PRODUCT"]
-        self.product_s3_href = self.product["alternate"]["s3"]["href"]
+        if "QUICKLOOK" in data["assets"]:
+            self.quicklook_href = data["assets"]["QUICKLOOK"]["href"]
+        self.product_s3_href = data["assets"]["PRODUCT"]["alternate"]["s3"]["href"]
+        # With raw text available the parsed dict is not kept around
+        self._raw = raw
+        self._data = data if raw is None else None
+
+    @staticmethod
+    def from_raw(raw: str) -> "Feature":
+        return Feature(json.loads(raw), raw)
+
+    @property
+    def data(self) -> dict:
+        """The whole STAC item, parsed again on every access of a compact one."""
+        if self._data is not None:
+            return self._data
+        return json.loads(self._raw)
+
+    @property
+    def raw(self) -> str:
+        """The STAC item as JSON text, without parsing it."""
+        if self._raw is not None:
+            return self._raw
+        return json.dumps(self._data)
 
+    @property
+    def properties(self) -> dict:
+        return self.data["properties"]
+
+    @property
+    def product(self) -> dict:
+        return self.data["assets"]["PRODUCT"]
 
     def __str__(self):
         return f"({self.datetime}) thumbnail: {self.quicklook_href}"
@@ -29,10 +82,98 @@ class Feature:
         return self.datetime < other.datetime
 
 
+class FeatureStream:
+    """
+    Incrementally decode a FeatureCollection from a text file object, one
+    feature at a time, without loading the whole response. Iterating yields
+    Features, afterwards `rest` holds the other top level keys (links etc.).
+    """
+
+    def __init__(self, fp, chunk_size: int = 1 << 16):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.rest = {}
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop what is already consumed
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of FeatureCollection")
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f"Expected {char!r} at {self.pos}, got {self._peek()!r}")
+        self.pos += 1
+
+    def _value(self):
+        """Decode the next JSON value, returns (value, raw text)."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    break
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+        raw = self.buf[self.pos : end]
+        self.pos = end
+        return value, raw
+
+    def __iter__(self):
+        self._expect("{")
+        while self._peek() != "}":
+            key, _ = self._value()
+            self._expect(":")
+            if key == "features":
+                self._expect("[")
+                while self._peek() != "]":
+                    data, raw = self._value()
+                    yield Feature(data, raw)
+                    if self._peek() == ",":
+                        self.pos += 1
+                self.pos += 1
+            else:
+                self.rest[key], _ = self._value()
+            if self._peek() == ",":
+                self.pos += 1
+
+
 class FeatureCollection:
-    def __init__(self, data):
+    def __init__(self, data, features: list[Feature] = None):
         self.data = data
-        self.features = [Feature(f) for f in self.data["features"]]
+        if features is None:
+            features = [Feature(f) for f in self.data["features"]]
+        self.features = features
+
+    @staticmethod
+    def load(path: str) -> "FeatureCollection":
+        """Stream a FeatureCollection file, keeping only compact Features."""
+        with open(path) as f:
+            stream = FeatureStream(f)
+            features = list(stream)
+        return FeatureCollection(stream.rest, features)
 
     def __len__(self):
         return len(self.features)
@@ -44,41 +185,345 @@ class FeatureCollection:
         return "\n".join([str(f) for f in self.features])
 
 
+# Open ("..") starts, the first Sentinel-2 launch
+MISSION_START = datetime(2015, 6, 23)
+
+
+def parse_time(value: str, end: bool = False) -> datetime:
+    """
+    An ISO date or timestamp of a STAC time range as naive UTC. A date-only
+    end includes that whole day, so the end is returned exclusive.
+    """
+    if value in ("", ".."):
+        if end:
+            return datetime.now(timezone.utc).replace(tzinfo=None)
+        return MISSION_START
+    # fromisoformat only takes "Z" from Python 3.11 on
+    t = datetime.fromisoformat(value[:-1] + "+00:00" if value[-1] == "Z" else value)
+    if t.tzinfo is not None:
+        t = t.astimezone(timezone.utc).replace(tzinfo=None)
+    if end:
+        t += timedelta(days=1) if len(value) == 10 else timedelta(milliseconds=1)
+    return t
+
+
+def split_time_range(time_range: str, days: int) -> list[str]:
+    """Split "start/end" into consecutive intervals of at most `days` days."""
+    start, end = time_range.split("/")
+    start = parse_time(start)
+    end = parse_time(end, end=True)
+    ranges = []
+    while start < end:
+        stop = min(start + timedelta(days=days), end)
+        ranges.append(
+            start.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+            + "/"
+            + (stop - timedelta(milliseconds=1)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        )
+        start = stop
+    return ranges
+
+
+def split_bbox(bbox, max_size: float) -> list[list[float]]:
+    """Split bbox into a grid of boxes at most max_size degrees wide/high."""
+    min_x, min_y, max_x, max_y = bbox
+    nx = max(1, math.ceil((max_x - min_x) / max_size))
+    ny = max(1, math.ceil((max_y - min_y) / max_size))
+    dx = (max_x - min_x) / nx
+    dy = (max_y - min_y) / ny
+    return [
+        [min_x + i * dx, min_y + j * dy, min_x + (i + 1) * dx, min_y + (j + 1) * dy]
+        for i in range(nx)
+        for j in range(ny)
+    ]
+
+
+def next_link(data: dict) -> str | None:
+    for link in data.get("links", []):
+        if link.get("rel") == "next":
+            return link["href"]
+    return None
+
+
+class StacClient:
+    """
+    Async STAC item search. Follows `next` links, runs the sub-queries of a
+    large bbox/time range concurrently, dedups features by id and caches
+    every response page on disk, keyed by url and query.
+    """
+
+    def __init__(
+        self,
+        endpoint: str = stac_endpoint,
+        cache_dir: str | None = default_cache_dir,
+        cache_ttl: float | None = 24 * 3600,
+        max_concurrency: int = 8,
+        split_days: int = 31,
+        max_bbox_size: float = 2.0,
+        timeout: float = 60.0,
+    ):
+        self.endpoint = endpoint
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.max_concurrency = max_concurrency
+        self.split_days = split_days
+        self.max_bbox_size = max_bbox_size
+        self.timeout = timeout
+
+    def _cache_path(self, url: str, params: dict | None) -> str | None:
+        if self.cache_dir is None:
+            return None
+        key = json.dumps([url, params], sort_keys=True)
+        name = hashlib.sha1(key.encode()).hexdigest() + ".json"
+        return os.path.join(self.cache_dir, name)
+
+    def _read_cache(self, path: str | None) -> str | None:
+        if path is None or not os.path.isfile(path):
+            return None
+        if self.cache_ttl is not None:
+            if time.time() - os.path.getmtime(path) > self.cache_ttl:
+                return None
+        with open(path) as f:
+            return f.read()
+
+    def _write_cache(self, path: str | None, text: str):
+        if path is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    async def _get_page(
+        self, client, semaphore, url: str, params: dict = None
+    ) -> tuple[list[Feature], dict]:
+        """
+        Compact Features of a response page (from the cache if fresh) and
+        the page's other top level keys.
+        """
+        path = self._cache_path(url, params)
+        text = self._read_cache(path)
+        if text is None:
+            async with semaphore:
+                response = await client.get(url, params=params)
+            response.raise_for_status()
+            text = response.text
+            self._write_cache(path, text)
+        stream = FeatureStream(io.StringIO(text))
+        features = list(stream)
+        return features, stream.rest
+
+    async def _search_pages(self, client, semaphore, url: str, params: dict):
+        page, rest = await self._get_page(client, semaphore, url, params)
+        features = page
+        # Pages of one query depend on each other, so these are sequential
+        while (href := next_link(rest)) is not None and page:
+            page, rest = await self._get_page(client, semaphore, href)
+            features += page
+        return features
+
+    def queries(self, bbox, time_range: str, limit: int) -> list[dict]:
+        return [
+            {
+                "bbox": ",".join([str(x) for x in sub_bbox]),
+                "datetime": sub_range,
+                "limit": limit,
+            }
+            for sub_bbox in split_bbox(bbox, self.max_bbox_size)
+            for sub_range in split_time_range(time_range, self.split_days)
+        ]
+
+    async def search(
+        self, bbox, time_range: str, limit: int = 100, sensor: str = "SENTINEL-2"
+    ) -> "FeatureCollection":
+        url = f"{self.endpoint}/{sensor}/items"
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            pages = await asyncio.gather(
+                *[
+                    self._search_pages(client, semaphore, url, params)
+                    for params in self.queries(bbox, time_range, limit)
+                ]
+            )
+        features = {}
+        for page in pages:
+            for feature in page:
+                features.setdefault(feature.id, feature)
+        return FeatureCollection(
+            {"type": "FeatureCollection"}, list(features.values())
+        )
+
+
 def search(
     bbox=[12.41, 41.80, 12.52, 41.90],
     time_range="2022-01-01/2022-03-01",
     limit=100,
     sensor="SENTINEL-2",
+    client: StacClient = None,
 ):
+    print("Search:", bbox, time_range)
+    client = client or StacClient()
+    return asyncio.run(client.search(bbox, time_range, limit, sensor))
+
+
+def load_collection(path="resources/feature_collection.json"):
+    return FeatureCollection.load(path)
+
+
+def _bench_parse(n=10_000):
+    import tempfile
+    import tracemalloc
+
     with open("resources/feature_collection.json") as f:
         data = json.load(f)
-        return FeatureCollection(data)
-    print("Search:", bbox, time_range)
-    # Construct the search query
-    search_params = {
-        "bbox": ",".join([str(x) for x in bbox]),
-        "datetime": time_range,
-        "limit": limit,
+    items = data["features"]
+    data["features"] = [
+        {**items[i % len(items)], "id": f"{i}_{items[i % len(items)]['id']}"}
+        for i in range(n)
+    ]
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+        json.dump(data, f)
+        f.flush()
+        del data, items
+
+        def eager():
+            with open(f.name) as fp:
+                return FeatureCollection(json.load(fp))
+
+        def stream():
+            return load_collection(f.name)
+
+        for name, read in [("json.load", eager), ("stream", stream)]:
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            collection = read()
+            dt = time.perf_counter() - t0
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(
+                f"{name:10s} {len(collection)} features {dt:6.2f} s, "
+                + f"retained {current / 2**20:6.1f} MB, peak {peak / 2**20:6.1f} MB"
+            )
+            del collection
+
+
+def _stub_feature(i: int) -> dict:
+    """A STAC item of the stub server, 0.5 degree boxes over [10, 50, 14, 52]."""
+    x, y = 10.0 + (i % 10) * 0.38, 50.0 + (i // 10) * 0.15
+    t = datetime(2023, 1, 1, 10) + timedelta(hours=21 * i)
+    return {
+        "id": f"S2A_MSIL2A_{t:%Y%m%dT%H%M%S}_N0509_R065_T33UVP_{i:03d}",
+        "bbox": [x, y, x + 0.5, y + 0.5],
+        "properties": {
+            "datetime": t.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "cloudCover": float(i % 100),
+            "productType": "S2MSI2A",
+        },
+        "assets": {
+            "PRODUCT": {"alternate": {"s3": {"href": f"/eodata/{i}.SAFE"}}},
+        },
     }
 
-    url = f"{stac_endpoint}/{sensor}/items?"
 
-    # Make the API request
-    response = requests.get(url, params=search_params)
-    # Check if the request was successful
-    if response.status_code != 200:
-        print("Failed to fetch data:", response.status_code)
-        return []
+def _stub_server(items: list[dict], calls: list[dict]):
+    """
+    A STAC item search on localhost, filters items by the bbox and datetime
+    parameters, `limit` per page with `next` links. Records the queries and
+    how many items each returned ("returned").
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qsl, urlencode, urlsplit
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query))
+            calls.append(params)
+            min_x, min_y, max_x, max_y = map(float, params["bbox"].split(","))
+            start, end = params["datetime"].split("/")
+            start, end = parse_time(start), parse_time(end, end=True)
+            found = [
+                item
+                for item in items
+                if item["bbox"][0] <= max_x
+                and item["bbox"][2] >= min_x
+                and item["bbox"][1] <= max_y
+                and item["bbox"][3] >= min_y
+                and start <= parse_time(item["properties"]["datetime"]) < end
+            ]
+            limit, page = int(params["limit"]), int(params.get("page", 0))
+            body = {
+                "type": "FeatureCollection",
+                "features": found[page * limit : (page + 1) * limit],
+                "links": [],
+            }
+            params["returned"] = len(body["features"])
+            if (page + 1) * limit < len(found):
+                query = urlencode(
+                    {k: v for k, v in params.items() if k != "returned"}
+                    | {"page": page + 1}
+                )
+                href = f"http://{self.headers['Host']}{url.path}?{query}"
+                body["links"].append({"rel": "next", "href": href})
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/geo+json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
 
-    data = response.json()
-    collection = FeatureCollection(data)
-    # with open("feature_collection.json", "w") as f:
-    #     json.dump(data, f, indent=2)
+def _check_search(n: int = 100):
+    assert split_time_range("2023-01-01/2023-03-31", 31) == [
+        "2023-01-01T00:00:00.000000Z/2023-01-31T23:59:59.999000Z",
+        "2023-02-01T00:00:00.000000Z/2023-03-03T23:59:59.999000Z",
+        "2023-03-04T00:00:00.000000Z/2023-03-31T23:59:59.999000Z",
+    ]
+    assert split_time_range("2023-01-01T12:00:00Z/2023-01-02T11:59:59Z", 31) == [
+        "2023-01-01T12:00:00.000000Z/2023-01-02T11:59:59.000000Z"
+    ]
+    assert split_time_range("../2015-06-30", 7)[0].startswith("2015-06-23T00:00")
+    assert split_bbox([10, 50, 14, 52], 2.0) == [[10, 50, 12, 52], [12, 50, 14, 52]]
 
-    return collection
+    items = [_stub_feature(i) for i in range(n)]
+    calls = []
+    server = _stub_server(items, calls)
+    try:
+        client = StacClient(
+            f"http://127.0.0.1:{server.server_address[1]}",
+            cache_dir=None,
+            max_bbox_size=2.0,
+            split_days=31,
+        )
+        time_range = "2023-01-01/2023-03-31"
+        collection = asyncio.run(client.search([10, 50, 14, 52], time_range, 10))
+    finally:
+        server.shutdown()
+        server.server_close()
+    ids = [feature.id for feature in collection]
+    # Boxes across the split are found by both sub-queries, returned once
+    assert sum(params["returned"] for params in calls) > n
+    assert len(ids) == len(set(ids)) == n, (len(ids), len(set(ids)))
+    assert set(ids) == {item["id"] for item in items}
+    queries = client.queries([10, 50, 14, 52], time_range, 10)
+    assert len(queries) == 6
+    assert sum("page" in params for params in calls) > 0
+    assert len(calls) > len(queries)
+    print(f"search ok, {len(ids)} features from {len(calls)} pages")
 
 
 if __name__ == "__main__":
+    _check_search()
+    _bench_parse()
     collection = search()
     print(len(collection))
     for feature in collection:
@@ -0,0 +1,122 @@
+"""
+Incremental catalogue sync of named areas of interest.
+
+Each AOI keeps a high-water mark (the latest item datetime seen, in
+SyncState), and a sync only asks STAC for items from a few days before the
+mark, the lookback covers products that are published a while after they
+were acquired. Ids are checked against the index in bulk and only new
+items are inserted (or queued for download), so a daily sync is a handful
+of small queries.
+
+    python -m satd.sync /data/sentinel-2/index.db linkoping 15.5 58.3 15.7 58.5
+"""
+
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+from satd.bands import DownloadProfile
+from satd.db.table import init_db, transaction
+from satd.db.table_ingest_job import IngestJob
+from satd.db.table_sentinel_image import SentinelImage
+from satd.db.table_sync_state import SyncState
+from satd.search import Feature, StacClient, search
+import satd.footprint as footprints
+
+
+def sync(
+    name: str,
+    bbox=None,
+    start: str = None,
+    lookback_days: int = 5,
+    product_type: str = None,
+    profile: DownloadProfile = None,
+    min_coverage: float = None,
+    client: StacClient = None,
+) -> list[Feature]:
+    """
+    Fetch the items of the AOI newer than its high-water mark (or from
+    start, default 30 days ago, on the first sync) and index the new ones.
+    With a profile, new items are queued for download instead, and their
+    rows are inserted by the ingest workers. With min_coverage, items whose
+    footprint covers less than that percent of the AOI are skipped (but
+    still move the high-water mark). Returns the new features.
+    """
+    state = SyncState.get(name)
+    if state is None:
+        if bbox is None:
+            raise ValueError(f"Unknown AOI {name!r}, a bbox is needed")
+        state = SyncState(name=name, bbox=json.dumps(list(bbox)))
+    elif bbox is not None:
+        state.bbox = json.dumps(list(bbox))
+
+    now = datetime.now(timezone.utc)
+    if state.high_water:
+        mark = datetime.fromisoformat(state.high_water[:10])
+        start = (mark - timedelta(days=lookback_days)).strftime("%Y-%m-%d")
+    elif start is None:
+        start = (now - timedelta(days=30)).strftime("%Y-%m-%d")
+    time_range = f"{start}/{now.strftime('%Y-%m-%d')}"
+
+    # Recent pages change, don't serve them from the disk cache
+    client = client or StacClient(cache_dir=None)
+    t0 = time.perf_counter()
+    features = [
+        feature
+        for feature in search(state.get_bbox(), time_range, client=client)
+        if product_type is None or feature.product_type == product_type
+    ]
+    t_search = time.perf_counter() - t0
+
+    existing = SentinelImage.existing([f.id for f in features], "id_str")
+    new = [feature for feature in features if feature.id not in existing]
+    # Parsed once and only if needed, Feature.data parses on every access
+    items = []
+    if profile is None or min_coverage is not None:
+        items = [feature.data for feature in new]
+    if min_coverage is not None and new:
+        polygons = footprints.to_polygons(
+            [footprints.from_geojson(item.get("geometry")) for item in items],
+            [item["bbox"] for item in items],
+        )
+        covered = footprints.coverage(polygons, state.get_bbox())
+        keep = covered >= min_coverage
+        new = [f for f, ok in zip(new, keep) if ok]
+        items = [item for item, ok in zip(items, keep) if ok]
+    with transaction():
+        if profile is None:
+            SentinelImage.insert_many([SentinelImage.from_json(x) for x in items])
+        else:
+            # Products of earlier jobs get the bands the profile adds
+            jobs = IngestJob.states([f.id for f in features if f.id in existing])
+            IngestJob.enqueue(new + [f for f in features if f.id in jobs], profile)
+        state.high_water = max(
+            [state.high_water] + [feature.datetime for feature in features]
+        )
+        state.items += len(new)
+        SyncState.save(state)
+    print(
+        f"Sync {name} {time_range}: {len(features)} items, {len(new)} new, "
+        + f"search {t_search:.1f} s, high-water {state.high_water}"
+    )
+    return new
+
+
+def sync_all(**kwargs) -> dict[str, list[Feature]]:
+    """Sync every AOI that has been synced before."""
+    return {state.name: sync(state.name, **kwargs) for state in SyncState.select()}
+
+
+if __name__ == "__main__":
+    import sys
+
+    db_path, *args = sys.argv[1:]
+    init_db(db_path)
+    SentinelImage.create_table()
+    IngestJob.create_table()
+    SyncState.create_table()
+    if args:
+        name, *bbox = args
+        sync(name, [float(x) for x in bbox] or None)
+    else:
+        sync_all()
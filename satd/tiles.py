@@ -0,0 +1,202 @@
+"""
+XYZ (web mercator) RGB tile pyramid of downloaded scenes.
+
+Tiles are rendered lazily on first request by warping the scene's RGB bands
+(a VRT over its band files) into the tile with gdal.Warp, which also picks
+the JP2 overview level. Rendered tiles are PNGs (nodata transparent) in an
+MBTiles-like SQLite file next to index.db, evicted least recently used
+once the store grows past its byte budget.
+"""
+
+import math
+import os
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+from osgeo import gdal
+from PIL import Image
+
+from satd.bands import RGB
+from satd.db.connection import Database
+from satd.db.table_sentinel_image import SentinelImage
+from satd.raster import Stretch, default_stretch, open_photo
+
+MB = 1024 * 1024
+
+# Half the circumference of the earth in web mercator meters
+ORIGIN = 20037508.342789244
+
+
+def lonlat_to_tile(lon: float, lat: float, z: int) -> tuple[int, int]:
+    n = 1 << z
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """(min_x, min_y, max_x, max_y) of a tile in EPSG:3857 meters."""
+    size = 2 * ORIGIN / (1 << z)
+    return (
+        -ORIGIN + x * size,
+        ORIGIN - (y + 1) * size,
+        -ORIGIN + (x + 1) * size,
+        ORIGIN - y * size,
+    )
+
+
+def tiles_in_bbox(bbox, z: int):
+    min_x, min_y, max_x, max_y = bbox
+    x1, y1 = lonlat_to_tile(min_x, max_y, z)
+    x2, y2 = lonlat_to_tile(max_x, min_y, z)
+    for x in range(x1, x2 + 1):
+        for y in range(y1, y2 + 1):
+            yield x, y
+
+
+def tile_in_bbox(bbox, z: int, x: int, y: int) -> bool:
+    min_x, min_y, max_x, max_y = bbox
+    x1, y1 = lonlat_to_tile(min_x, max_y, z)
+    x2, y2 = lonlat_to_tile(max_x, min_y, z)
+    return x1 <= x <= x2 and y1 <= y <= y2
+
+
+class TileStore:
+    def __init__(
+        self,
+        dir_path: str,
+        db_path: str = None,
+        max_bytes: int = 2048 * MB,
+        tile_size: int = 256,
+        stretch: Stretch = default_stretch,
+    ):
+        self.dir_path = dir_path
+        self.tile_size = tile_size
+        self.stretch = stretch
+        self.max_bytes = max_bytes
+        self.db = Database(db_path or os.path.join(dir_path, "tiles.db"))
+        self.db.get().execute(
+            """
+            CREATE TABLE IF NOT EXISTS tiles(
+              id_str TEXT,
+              z INTEGER,
+              x INTEGER,
+              y INTEGER,
+              data BLOB,
+              size INTEGER,
+              last_access REAL,
+              PRIMARY KEY (id_str, z, x, y)
+            );
+            """
+        )
+        self.db.get().execute(
+            "CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles(last_access);"
+        )
+        self.db.commit()
+        (total,) = self.db.get().execute("SELECT SUM(size) FROM tiles;").fetchone()
+        self.nbytes = total or 0
+        # Renders run concurrently (GDAL handles are per thread), nbytes is
+        # updated under this lock
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, id_str: str, z: int, x: int, y: int) -> bytes | None:
+        db = self.db.get()
+        key = (id_str, z, x, y)
+        row = db.execute(
+            "SELECT data FROM tiles WHERE id_str=? AND z=? AND x=? AND y=?;", key
+        ).fetchone()
+        if row is None:
+            return None
+        db.execute(
+            "UPDATE tiles SET last_access=? WHERE id_str=? AND z=? AND x=? AND y=?;",
+            (time.time(), *key),
+        )
+        self.db.commit()
+        return row[0]
+
+    def _store(self, id_str: str, z: int, x: int, y: int, data: bytes):
+        with self.db.transaction() as db:
+            # Another request may have rendered the same tile meanwhile
+            cur = db.execute(
+                "INSERT OR IGNORE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?);",
+                (id_str, z, x, y, data, len(data), time.time()),
+            )
+        with self.lock:
+            self.nbytes += len(data) * cur.rowcount
+            over = self.nbytes > self.max_bytes
+        if over:
+            self.evict(int(self.max_bytes * 0.9))
+
+    def evict(self, target_bytes: int):
+        """Drop least recently used tiles until at most target_bytes remain."""
+        with self.lock, self.db.transaction() as db:
+            rows = db.execute(
+                "SELECT rowid, size FROM tiles ORDER BY last_access;"
+            ).fetchall()
+            drop = []
+            for rowid, size in rows:
+                if self.nbytes <= target_bytes:
+                    break
+                drop.append((rowid,))
+                self.nbytes -= size
+            db.executemany("DELETE FROM tiles WHERE rowid=?;", drop)
+
+    def render(self, image: SentinelImage, z: int, x: int, y: int) -> bytes | None:
+        """PNG of the tile, None if the scene's RGB bands are not on disk."""
+        paths = image.band_paths(self.dir_path, RGB)
+        if paths is None:
+            return None
+        photos = [open_photo(path) for path in paths]
+        vrt = gdal.BuildVRT("", [photo.ds for photo in photos], separate=True)
+        min_x, min_y, max_x, max_y = tile_bounds(z, x, y)
+        ds = gdal.Warp(
+            "",
+            vrt,
+            format="MEM",
+            dstSRS="EPSG:3857",
+            outputBounds=(min_x, min_y, max_x, max_y),
+            width=self.tile_size,
+            height=self.tile_size,
+            resampleAlg="bilinear",
+            srcNodata=0,
+            dstNodata=0,
+        )
+        rgba = np.empty((self.tile_size, self.tile_size, 4), np.uint8)
+        valid = np.zeros((self.tile_size, self.tile_size), bool)
+        for i in range(3):
+            data = ds.GetRasterBand(i + 1).ReadAsArray()
+            valid |= data > 0
+            self.stretch.apply(data, out=rgba[..., i])
+        rgba[..., 3] = np.where(valid, 255, 0)
+        out = BytesIO()
+        Image.fromarray(rgba, "RGBA").save(out, "PNG")
+        return out.getvalue()
+
+    def get_tile(self, image: SentinelImage, z: int, x: int, y: int) -> bytes | None:
+        """
+        PNG bytes of the tile, None if the scene doesn't cover it or its RGB
+        bands are not on disk.
+        """
+        if not tile_in_bbox(image.bbox, z, x, y):
+            return None
+        data = self._lookup(image.id_str, z, x, y)
+        if data is not None:
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = self.render(image, z, x, y)
+        if data is None:
+            return None
+        self._store(image.id_str, z, x, y, data)
+        return data
+
+    def build(self, image: SentinelImage, min_zoom: int = 8, max_zoom: int = 14):
+        """Render every missing tile of the scene from min_zoom to max_zoom."""
+        for z in range(min_zoom, max_zoom + 1):
+            for x, y in tiles_in_bbox(image.bbox, z):
+                self.get_tile(image, z, x, y)
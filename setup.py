@@ -1,3 +1,8 @@
 from setuptools import setup, find_packages
 
-setup(name='satd', version='1.0', packages=find_packages())
\ No newline at end of file
+setup(
+    name='satd',
+    version='1.0',
+    packages=find_packages(),
+    entry_points={"console_scripts": ["satd=satd.cli:main"]},
+)